@@ -0,0 +1,39 @@
+"""
+Measure the cost of looking up the component constructors :meth:`.MzMLWriter.write_spectrum`
+uses for each spectrum, with and without the constructors cached on the dispatcher.
+
+Usage, from the repository root: PYTHONPATH=. python benchmarks/component_dispatch.py [n_spectra]
+"""
+import sys
+import timeit
+
+from mzml_writer.components import ChildTrackingMeta, ComponentDispatcher, ReprBorrowingPartial
+
+
+# The constructors one spectrum with a precursor looks up
+names = ["Scan", "ScanList", "Spectrum", "Precursor", "PrecursorList", "SelectedIon",
+         "SelectedIonList", "BinaryDataArray", "BinaryDataArray", "Binary", "Binary",
+         "BinaryDataArrayList"]
+
+
+def uncached(dispatcher):
+    # What every lookup cost before constructors were cached
+    for name in names:
+        ReprBorrowingPartial(ChildTrackingMeta._cache[name], context=dispatcher.context)
+
+
+def cached(dispatcher):
+    for name in names:
+        getattr(dispatcher, name)
+
+
+def main(n_spectra=100000):
+    dispatcher = ComponentDispatcher()
+    for label, func in (("uncached", uncached), ("cached", cached)):
+        elapsed = timeit.timeit(lambda: func(dispatcher), number=n_spectra)
+        print("%-9s %.3fs for %d spectra, %.2fus per spectrum" % (
+            label, elapsed, n_spectra, elapsed / n_spectra * 1e6))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
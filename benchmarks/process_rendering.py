@@ -0,0 +1,50 @@
+"""
+Measure the time to write an indexed document of spectra serially and with the spectra
+rendered in worker processes, for each number of processes given.
+
+Usage, from the repository root:
+PYTHONPATH=. python benchmarks/process_rendering.py [n_spectra [n_processes ...]]
+"""
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from mzml_writer.writer import MzMLWriter
+
+
+def make_spectra(n_distinct=200, n_points=400):
+    rng = np.random.RandomState(1)
+    return [(np.sort(rng.uniform(100, 2000, n_points)), rng.uniform(0, 1e6, n_points))
+            for _ in range(n_distinct)]
+
+
+def write(spectra, n_spectra, rendering_processes=None):
+    with tempfile.TemporaryFile() as outfile:
+        mzml_writer = MzMLWriter(
+            outfile, indexed=True, backend="bytes", rendering_processes=rendering_processes)
+        start = time.time()
+        with mzml_writer:
+            mzml_writer.controlled_vocabularies()
+            with mzml_writer.element('run'):
+                with mzml_writer.element('spectrumList', count=n_spectra):
+                    for i in range(n_spectra):
+                        mz, intensity = spectra[i % len(spectra)]
+                        mzml_writer.write_spectrum(
+                            mz, intensity, id='scan=%d' % i, scan_start_time=i * 0.01,
+                            params=[{"name": "ms level", "value": 1}])
+        return time.time() - start
+
+
+def main(n_spectra=5000, *n_processes):
+    spectra = make_spectra()
+    for processes in (None,) + (n_processes or (1, 2, 4)):
+        elapsed = write(spectra, n_spectra, processes)
+        print("%-11s %.3fs for %d spectra, %.1fus per spectrum" % (
+            "serial" if processes is None else "%d process%s" % (processes, "es" * (processes > 1)),
+            elapsed, n_spectra, elapsed / n_spectra * 1e6))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
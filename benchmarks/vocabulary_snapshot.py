@@ -0,0 +1,44 @@
+"""
+Measure the cost of loading a controlled vocabulary by parsing its OBO file and
+by reading the snapshot :meth:`.OBOCache.load_vocabulary` stores of it.
+
+Usage, from the repository root, once the vocabulary has been downloaded to .obo_cache:
+PYTHONPATH=. python benchmarks/vocabulary_snapshot.py [name] [repeats]
+"""
+import marshal
+import os
+import sys
+import timeit
+
+from mzml_writer.controlled_vocabulary import ControlledVocabulary, OBOCache, _snapshot_suffix
+
+
+def main(name="psi-ms", repeats=5):
+    cache = OBOCache()
+    path = cache.path_for(name)
+    # Stores the snapshot when it is missing or out of date
+    cache.load_vocabulary(name)
+    snapshot_path = path + _snapshot_suffix
+
+    def parse():
+        # Read as load_vocabulary reads it
+        with cache.resolve(name) as fh:
+            ControlledVocabulary.from_obo(fh.read().splitlines())
+
+    def load_snapshot():
+        with open(snapshot_path, 'rb') as fh:
+            ControlledVocabulary.from_snapshot(marshal.loads(fh.read())[1])
+
+    def load_vocabulary():
+        cache.load_vocabulary(name)
+
+    print("%s, %d bytes of OBO, %d bytes of snapshot" % (
+        name, os.path.getsize(path), os.path.getsize(snapshot_path)))
+    for label, func in (("parse", parse), ("snapshot", load_snapshot),
+                        ("load_vocabulary", load_vocabulary)):
+        elapsed = min(timeit.repeat(func, number=1, repeat=repeats))
+        print("%-16s %.1fms" % (label, elapsed * 1e3))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) if arg.isdigit() else arg for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+"""
+Measure the time to write a batch of small spectra with one call to
+:meth:`.MzMLWriter.write_spectra` against one call to :meth:`.MzMLWriter.write_spectrum`
+per spectrum, for each backend.
+
+Usage, from the repository root:
+PYTHONPATH=. python benchmarks/write_spectra.py [n_spectra [n_points]]
+"""
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from mzml_writer.writer import MzMLWriter
+
+
+def make_batch(n_spectra, n_points):
+    rng = np.random.RandomState(1)
+    mz = np.sort(rng.uniform(100, 2000, (n_spectra, n_points)), axis=1).ravel()
+    intensity = rng.uniform(0, 1e6, n_spectra * n_points)
+    offsets = np.arange(n_spectra + 1) * n_points
+    ids = ['scan=%d' % i for i in range(n_spectra)]
+    return mz, intensity, offsets, ids
+
+
+def write_individually(mzml_writer, mz, intensity, offsets, ids):
+    for i, scan_id in enumerate(ids):
+        start, end = offsets[i], offsets[i + 1]
+        mzml_writer.write_spectrum(
+            mz[start:end], intensity[start:end], id=scan_id, scan_start_time=i * 0.01,
+            params=[{"name": "ms level", "value": 2}])
+
+
+def write_batch(mzml_writer, mz, intensity, offsets, ids):
+    mzml_writer.write_spectra(
+        mz, intensity, offsets, ids=ids, scan_start_times=np.arange(len(ids)) * 0.01,
+        ms_levels=2)
+
+
+def time_writing(write, batch, **kwargs):
+    with tempfile.TemporaryFile() as outfile:
+        mzml_writer = MzMLWriter(outfile, **kwargs)
+        with mzml_writer:
+            mzml_writer.controlled_vocabularies()
+            with mzml_writer.element('run'):
+                start = time.time()
+                write(mzml_writer, *batch)
+                mzml_writer._flush_pending()
+                return time.time() - start
+
+
+def main(n_spectra=3000, n_points=20):
+    batch = make_batch(n_spectra, n_points)
+    for label, kwargs in (("lxml", {}),
+                          ("bytes", {"backend": "bytes", "use_templates": False}),
+                          ("bytes, templates", {"backend": "bytes"})):
+        # Once first so that vocabularies are loaded before timing
+        time_writing(write_batch, batch, **kwargs)
+        individually = time_writing(write_individually, batch, **kwargs)
+        batched = time_writing(write_batch, batch, **kwargs)
+        print("%-17s write_spectrum %.3fs, write_spectra %.3fs, %.1fx" % (
+            label, individually, batched, individually / batched))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,111 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .deferred import DeferredElement, DeferredMzMLWriter
+
+try:
+    _running_loop = asyncio.get_running_loop
+except AttributeError:  # pragma: no cover
+    _running_loop = asyncio.get_event_loop
+
+
+class _AsyncElement(DeferredElement):
+    def __init__(self, writer, element_name, kwargs):
+        super(_AsyncElement, self).__init__(writer.mzml_writer, element_name, kwargs)
+        self.writer = writer
+
+    async def __aenter__(self):
+        await self.writer._open_element(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.writer._close_element(self)
+
+
+class AsyncMzMLWriter(DeferredMzMLWriter):
+    """
+    A front end to :class:`~.MzMLWriter` for :mod:`asyncio` programs, which does
+    all of the encoding, serialization and writing in an executor so that the event
+    loop is never blocked by them.
+
+    The writer is used with ``async with``, and its writing methods are awaited.
+    Awaiting one schedules the call and returns once it is scheduled, not once it is
+    carried out, so a producer can go on to the next spectrum while the previous ones
+    are written. Calls are carried out one at a time in the order they were made.
+    At most :attr:`max_in_flight` calls may be unfinished at once, beyond which
+    awaiting another waits for the oldest to finish, which bounds the memory held by
+    spectra waiting to be written. Arrays passed to a call are not copied, so they
+    must not be modified afterwards.
+
+    If a call fails, the remaining calls are discarded except for closing elements
+    and the document, and the error is raised by the next call to a writing method,
+    by :meth:`flush`, or when leaving the ``async with`` block.
+
+    Attributes
+    ----------
+    mzml_writer : :class:`~.MzMLWriter`
+        The writer the calls are carried out by. It must not be used directly
+        while the executor is running.
+    max_in_flight : int
+        The number of calls which may be unfinished at once
+    """
+    def __init__(self, outfile, max_in_flight=64, **kwargs):
+        super(AsyncMzMLWriter, self).__init__(outfile, **kwargs)
+        self.max_in_flight = max_in_flight
+        self._in_flight = deque()
+        self._executor = None
+        self._lock = None
+
+    async def _defer(self, func, args=(), kwargs=None, always=False):
+        # Waits while max_in_flight calls are unfinished
+        if not always:
+            self._raise_error()
+        loop = _running_loop()
+        # The lock hands out turns in the order they were asked for, and the single
+        # worker thread carries out calls in the order they were submitted
+        async with self._lock:
+            in_flight = self._in_flight
+            while len(in_flight) >= self.max_in_flight:
+                await in_flight.popleft()
+            in_flight.append(loop.run_in_executor(
+                self._executor, self._carry_out, func, args, kwargs, always))
+
+    async def _drain(self):
+        in_flight = self._in_flight
+        while in_flight:
+            await in_flight.popleft()
+
+    async def __aenter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = asyncio.Lock()
+        await self._open_document()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._close_document(exc_type, exc_value, traceback)
+        await self._drain()
+        self._executor.shutdown()
+        self._executor = None
+        if exc_type is None:
+            self._raise_error()
+
+    async def flush(self):
+        """
+        Wait until every scheduled call has been carried out and written
+        out, and raise the error from any which failed.
+        """
+        await self._defer(self._flush_writer)
+        await self._drain()
+        self._raise_error()
+
+    def element(self, element_name, **kwargs):
+        """
+        Create an asynchronous context manager which schedules writing the start
+        tag of `element_name` when entered, and its end tag when left.
+
+        See Also
+        --------
+        :meth:`.XMLWriterMixin.element`
+        """
+        return _AsyncElement(self, element_name, kwargs)
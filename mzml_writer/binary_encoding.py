@@ -1,21 +1,441 @@
 import base64
+import hashlib
+import tempfile
+import threading
 import zlib
+from collections import OrderedDict
+from math import floor
 
 import numpy as np
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    ThreadPoolExecutor = None
+
+
+_text_types = (bytes, type(u''))
+
 
 COMPRESSION_NONE = 'none'
 COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_NUMPRESS_LINEAR = 'numpress linear'
+COMPRESSION_NUMPRESS_SLOF = 'numpress slof'
+COMPRESSION_NUMPRESS_PIC = 'numpress pic'
+COMPRESSION_NUMPRESS_LINEAR_ZLIB = 'numpress linear zlib'
+COMPRESSION_NUMPRESS_SLOF_ZLIB = 'numpress slof zlib'
+COMPRESSION_NUMPRESS_PIC_ZLIB = 'numpress pic zlib'
 
 
 encoding_map = {
     32: np.float32,
-    64: np.float64
+    64: np.float64,
+    'float32': np.float32,
+    'float64': np.float64,
+    'int32': np.int32,
+    'int64': np.int64,
+}
+
+
+dtype_to_encoding = {
+    np.float32: "32-bit float",
+    np.float64: "64-bit float",
+    np.int32: "32-bit integer",
+    np.int64: "64-bit integer",
+}
+
+
+def infer_dtype(array):
+    """
+    Choose the encoding type for `array` from its own dtype. Integers are
+    stored as 32-bit integers when every value fits, and as 64-bit integers
+    otherwise. Floats keep their precision.
+
+    Parameters
+    ----------
+    array : array-like
+
+    Returns
+    -------
+    type
+        One of the keys of :data:`dtype_to_encoding`
+    """
+    array = np.asanyarray(array)
+    if array.dtype.kind in 'iub':
+        if len(array) == 0:
+            return np.int32
+        info = np.iinfo(np.int32)
+        if array.min() >= info.min and array.max() <= info.max:
+            return np.int32
+        return np.int64
+    elif array.dtype.kind == 'f' and array.dtype.itemsize <= 4:
+        return np.float32
+    return np.float64
+
+
+def resolve_dtype(encoding, array=None):
+    """
+    Translate an encoding specification into the type to encode with.
+
+    Parameters
+    ----------
+    encoding : int, str, type or :const:`None`
+        A key of :data:`encoding_map` such as 32, 64 or "int32", anything
+        :class:`np.dtype` accepts, or :const:`None` to infer the type from `array`
+    array : array-like, optional
+        The array to be encoded, used when `encoding` is :const:`None`
+
+    Returns
+    -------
+    type
+        One of the keys of :data:`dtype_to_encoding`
+    """
+    if encoding is None:
+        return infer_dtype(array)
+    try:
+        return encoding_map[encoding]
+    except (KeyError, TypeError):
+        pass
+    dtype = np.dtype(encoding)
+    for candidate in dtype_to_encoding:
+        if np.dtype(candidate) == dtype:
+            return candidate
+    raise ValueError("Unsupported encoding: %r" % (encoding,))
+
+
+# --------------------------------------------------
+# MS-Numpress
+#
+# NumPy ports of the MS-Numpress codecs, byte-compatible with the reference
+# implementation (https://github.com/ms-numpress/ms-numpress). Each codec works
+# on double precision values and yields a byte string prefixed, except for pic,
+# by the fixed point scaling factor as a big-endian double.
+
+
+_INT_MAX = 2 ** 31 - 1
+_INT_MIN = -2 ** 31
+_NIBBLE_SHIFTS = np.arange(0, 32, 4, dtype=np.uint32)
+
+
+def _encode_fixed_point(fixed_point):
+    return np.array([fixed_point], dtype='>f8').tobytes()
+
+
+def _decode_fixed_point(data):
+    if len(data) < 8:
+        raise ValueError("Corrupt MS-Numpress data: missing fixed point")
+    return float(np.frombuffer(data[:8], dtype='>f8')[0])
+
+
+def _encode_half_bytes(values):
+    """
+    Pack unsigned 32-bit integers into the MS-Numpress variable length
+    half-byte representation.
+
+    Each value is written as a header half-byte counting its leading zero
+    half-bytes (or, plus 8, its leading 0xf half-bytes) followed by its
+    remaining half-bytes, least significant first.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        An array of :obj:`np.uint32`
+
+    Returns
+    -------
+    bytes
+    """
+    count = len(values)
+    if count == 0:
+        return b''
+    nibbles = ((values[:, None] >> _NIBBLE_SHIFTS) & 0xf).astype(np.uint8)
+    most_significant_first = nibbles[:, ::-1]
+    negative = most_significant_first[:, 0] == 0xf
+    fill = np.where(negative, 0xf, 0).astype(np.uint8)
+    differs = most_significant_first != fill[:, None]
+    leading = np.where(differs.any(axis=1), differs.argmax(axis=1), 8)
+    leading = np.where(negative, np.minimum(leading, 7), leading)
+
+    table = np.empty((count, 9), dtype=np.uint8)
+    table[:, 0] = np.where(negative, leading + 8, leading)
+    table[:, 1:] = nibbles
+    stream = table[np.arange(9)[None, :] <= (8 - leading)[:, None]]
+    if len(stream) % 2:
+        stream = np.append(stream, np.uint8(0))
+    return ((stream[0::2] << 4) | stream[1::2]).astype(np.uint8).tobytes()
+
+
+def _decode_half_bytes(data):
+    """
+    Unpack a stream of MS-Numpress half-byte encoded integers.
+
+    Parameters
+    ----------
+    data : bytes
+
+    Returns
+    -------
+    np.ndarray
+        An array of :obj:`np.uint32`
+    """
+    raw = np.frombuffer(data, dtype=np.uint8)
+    nibbles = np.empty(len(raw) * 2, dtype=np.uint8)
+    nibbles[0::2] = raw >> 4
+    nibbles[1::2] = raw & 0xf
+    payload_sizes = np.where(nibbles <= 8, 8 - nibbles.astype(np.intp), 16 - nibbles.astype(np.intp))
+
+    # Only the header positions are inherently sequential. Walk them over plain
+    # lists, then gather every value's half-bytes at once.
+    sizes = payload_sizes.tolist()
+    last = len(sizes) - 1
+    headers = []
+    position = 0
+    while position <= last:
+        # An odd number of half-bytes is padded with a trailing zero, which
+        # would otherwise read as the header of a full width value
+        if position == last and sizes[position] == 8:
+            break
+        headers.append(position)
+        position += 1 + sizes[position]
+    if position > last + 1:
+        raise ValueError("Corrupt MS-Numpress data: truncated half-byte stream")
+
+    headers = np.array(headers, dtype=np.intp)
+    sizes = payload_sizes[headers]
+    columns = np.arange(8)
+    valid = columns[None, :] < sizes[:, None]
+    indices = np.where(valid, headers[:, None] + 1 + columns[None, :], 0)
+    payload = np.where(valid, nibbles[indices], 0).astype(np.uint64)
+    values = np.bitwise_or.reduce(payload << (4 * columns).astype(np.uint64), axis=1)
+    fill = (np.uint64(0xffffffff) << (4 * sizes).astype(np.uint64)) & np.uint64(0xffffffff)
+    values = np.where(nibbles[headers] > 8, values | fill, values)
+    return values.astype(np.uint32)
+
+
+def optimal_linear_fixed_point(data):
+    data = np.asanyarray(data, dtype=np.float64)
+    if len(data) == 0:
+        return 0.
+    if len(data) == 1:
+        return floor(0x7FFFFFFF / data[0])
+    max_double = max(data[0], data[1])
+    if len(data) > 2:
+        extrapolated = data[1:-1] + (data[1:-1] - data[:-2])
+        max_double = max(max_double, np.ceil(np.abs(data[2:] - extrapolated) + 1).max())
+    return floor(0x7FFFFFFF / max_double)
+
+
+def encode_numpress_linear(data, fixed_point=None):
+    data = np.asanyarray(data, dtype=np.float64)
+    if fixed_point is None:
+        fixed_point = optimal_linear_fixed_point(data)
+    header = _encode_fixed_point(fixed_point)
+    if len(data) == 0:
+        return header
+    ints = (data * fixed_point + 0.5).astype(np.int64)
+    initial = (ints[:2] & 0xffffffff).astype('<u4').tobytes()
+    residuals = ints[2:] - 2 * ints[1:-1] + ints[:-2]
+    if len(residuals) and (residuals.max() > _INT_MAX or residuals.min() < _INT_MIN):
+        raise ValueError("Cannot encode with fixed point %r: residuals overflow 32 bits" % fixed_point)
+    return header + initial + _encode_half_bytes(residuals.astype(np.int32).view(np.uint32))
+
+
+def decode_numpress_linear(data):
+    fixed_point = _decode_fixed_point(data)
+    if len(data) == 8:
+        return np.array([], dtype=np.float64)
+    if len(data) < 12:
+        raise ValueError("Corrupt MS-Numpress data: truncated initial values")
+    initial = np.frombuffer(data[8:16], dtype='<u4').astype(np.int64)
+    residuals = _decode_half_bytes(data[16:]).view(np.int32).astype(np.int64)
+    if len(residuals):
+        steps = (initial[1] - initial[0]) + np.cumsum(residuals)
+        ints = np.concatenate([initial, initial[1] + np.cumsum(steps)])
+    else:
+        ints = initial
+    return ints / fixed_point
+
+
+def optimal_slof_fixed_point(data):
+    data = np.asanyarray(data, dtype=np.float64)
+    if len(data) == 0:
+        return 0.
+    max_double = max(1., np.log(data + 1).max())
+    return floor(0xFFFF / max_double)
+
+
+def encode_numpress_slof(data, fixed_point=None):
+    data = np.asanyarray(data, dtype=np.float64)
+    if fixed_point is None:
+        fixed_point = optimal_slof_fixed_point(data)
+    scaled = np.log(data + 1) * fixed_point
+    if len(scaled) and scaled.max() > 0xFFFF:
+        raise ValueError("Cannot encode with fixed point %r: values overflow 16 bits" % fixed_point)
+    return _encode_fixed_point(fixed_point) + (scaled + 0.5).astype('<u2').tobytes()
+
+
+def decode_numpress_slof(data):
+    fixed_point = _decode_fixed_point(data)
+    return np.exp(np.frombuffer(data[8:], dtype='<u2') / fixed_point) - 1
+
+
+def encode_numpress_pic(data):
+    data = np.asanyarray(data, dtype=np.float64)
+    if len(data) and ((data + 0.5).max() > _INT_MAX or data.min() < -0.5):
+        raise ValueError("MS-Numpress pic can only encode non-negative values below 2 ** 31")
+    return _encode_half_bytes((data + 0.5).astype(np.uint32))
+
+
+def decode_numpress_pic(data):
+    return _decode_half_bytes(data).astype(np.float64)
+
+
+# Maps each MS-Numpress compression to its encoder, decoder and whether
+# the result is further compressed with zlib
+numpress_codecs = {
+    COMPRESSION_NUMPRESS_LINEAR: (encode_numpress_linear, decode_numpress_linear, False),
+    COMPRESSION_NUMPRESS_SLOF: (encode_numpress_slof, decode_numpress_slof, False),
+    COMPRESSION_NUMPRESS_PIC: (encode_numpress_pic, decode_numpress_pic, False),
+    COMPRESSION_NUMPRESS_LINEAR_ZLIB: (encode_numpress_linear, decode_numpress_linear, True),
+    COMPRESSION_NUMPRESS_SLOF_ZLIB: (encode_numpress_slof, decode_numpress_slof, True),
+    COMPRESSION_NUMPRESS_PIC_ZLIB: (encode_numpress_pic, decode_numpress_pic, True),
+}
+
+
+def encoded_dtype(compression, dtype):
+    """
+    The type an array compressed with `compression` should be described as
+    having when it was to be encoded as `dtype`. MS-Numpress always decodes
+    to doubles, so anything it compresses is described as a 64-bit float.
+
+    Parameters
+    ----------
+    compression : str
+    dtype : type
+
+    Returns
+    -------
+    type
+    """
+    if compression in numpress_codecs:
+        return np.float64
+    return dtype
+
+
+def as_encodable_array(array, dtype=np.float32):
+    """
+    Coerce `array` to a C-contiguous, little-endian array of `dtype`,
+    copying only when the input is not already laid out that way.
+
+    Parameters
+    ----------
+    array : array-like
+    dtype : np.dtype, optional
+
+    Returns
+    -------
+    np.ndarray
+    """
+    return np.require(array, dtype=np.dtype(dtype).newbyteorder('<'), requirements='C')
+
+
+def array_buffer(array):
+    """
+    Expose a C-contiguous array's memory as a flat byte buffer which zlib
+    and base64 can consume without an intermediate :meth:`tobytes` copy.
+
+    Parameters
+    ----------
+    array : np.ndarray
+
+    Returns
+    -------
+    memoryview or np.ndarray
+    """
+    try:
+        return memoryview(array).cast('B')
+    except AttributeError:
+        # Python 2's memoryview cannot be cast, and its zlib and binascii only
+        # accept the old buffer interface, which ndarrays still provide
+        return array
+
+
+_float_bits_types = {
+    4: np.uint32,
+    8: np.uint64,
 }
 
 
+def truncate_mantissa(array, bits, dtype=np.float32):
+    """
+    Round `array` to `dtype` values with only `bits` significant mantissa bits,
+    zeroing the rest so that the array compresses far better with zlib.
+
+    Values are rounded to the nearest representable value, so the relative error
+    of each value is at most ``2 ** -(bits + 1)``. Zeros, infinities and NaNs are
+    left untouched.
+
+    Parameters
+    ----------
+    array : array-like
+        The values to round
+    bits : int
+        The number of explicit mantissa bits to keep, between 0 and 23 for
+        32-bit floats or 52 for 64-bit floats
+    dtype : type, optional
+        The floating point type the array will be encoded as
+
+    Returns
+    -------
+    np.ndarray
+        The rounded array, of type `dtype`
+    float
+        The largest relative error introduced into any value
+
+    Raises
+    ------
+    ValueError
+        If `dtype` is not a floating point type or `bits` is out of range
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'f' or dtype.itemsize not in _float_bits_types:
+        raise ValueError("Cannot truncate the mantissa of %s values" % (dtype,))
+    mantissa_bits = np.finfo(dtype).nmant
+    if not 0 <= bits <= mantissa_bits:
+        raise ValueError("%s values have between 0 and %d mantissa bits, not %r" % (
+            dtype, mantissa_bits, bits))
+    array = as_encodable_array(array, dtype)
+    dropped = mantissa_bits - bits
+    if dropped == 0 or array.size == 0:
+        return array, 0.0
+    uint = _float_bits_types[dtype.itemsize]
+    raw = array.view(uint)
+    mask = uint(~((1 << dropped) - 1) & ((1 << (8 * dtype.itemsize)) - 1))
+    # Adding half of the dropped range before masking rounds to nearest; a carry
+    # into the exponent correctly rounds up to the next power of two
+    rounded = ((raw + uint(1 << (dropped - 1))) & mask).view(array.dtype)
+    # Only the largest finite values can round up to infinity, and masking a NaN's
+    # payload could turn it into an infinity
+    keep = ~np.isfinite(rounded) | ~np.isfinite(array)
+    if keep.any():
+        rounded[keep] = array[keep]
+    nonzero = array != 0
+    with np.errstate(invalid='ignore'):
+        relative_error = np.abs(
+            (rounded[nonzero].astype(np.float64) - array[nonzero]) / array[nonzero])
+    relative_error = relative_error[np.isfinite(relative_error)]
+    max_error = float(relative_error.max()) if relative_error.size else 0.0
+    return rounded, max_error
+
+
 def encode_array(array, compression=COMPRESSION_NONE, dtype=np.float32):
-    bytestring = np.asanyarray(array).astype(dtype).tobytes()
+    if compression in numpress_codecs:
+        encoder, _, use_zlib = numpress_codecs[compression]
+        bytestring = encoder(array)
+        if use_zlib:
+            bytestring = zlib.compress(bytestring)
+        return base64.standard_b64encode(bytestring)
+    bytestring = array_buffer(as_encodable_array(array, dtype))
     if compression == COMPRESSION_NONE:
         bytestring = bytestring
     elif compression == COMPRESSION_ZLIB:
@@ -26,17 +446,385 @@ def encode_array(array, compression=COMPRESSION_NONE, dtype=np.float32):
     return encoded_string
 
 
-def decode_array(bytestring, compression=COMPRESSION_NONE, dtype=np.float32):
-    try:
-        decoded_string = bytestring.encode("ascii")
-    except AttributeError:
-        decoded_string = bytestring
-    decoded_string = base64.decodestring(decoded_string)
-    if compression == COMPRESSION_NONE:
-        decoded_string = decoded_string
-    elif compression == COMPRESSION_ZLIB:
+class EncodedArrayCache(object):
+    """
+    A least-recently-used cache of encoded arrays, keyed by a digest of the
+    array's raw bytes along with the type and compression it was encoded with.
+
+    Useful when the same array is written many times, like the shared m/z axis of
+    profile spectra from a fixed-binning instrument. The cache is safe to share
+    between threads.
+
+    Attributes
+    ----------
+    max_size : int
+        The most encoded bytes to hold at once before evicting the least recently used
+    size : int
+        The number of encoded bytes currently held
+    hits : int
+        The number of encodings served from the cache
+    misses : int
+        The number of encodings which had to be computed
+    """
+    def __init__(self, max_size=2 ** 26):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key_for(self, array, compression=COMPRESSION_NONE, dtype=np.float32):
+        array = as_encodable_array(array, dtype)
+        return (hashlib.sha1(array_buffer(array)).digest(), len(array), array.dtype.str, compression)
+
+    def get(self, key):
+        with self._lock:
+            encoded = self._store.pop(key, None)
+            if encoded is None:
+                self.misses += 1
+            else:
+                self._store[key] = encoded
+                self.hits += 1
+            return encoded
+
+    def put(self, key, encoded):
+        size = len(encoded)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._store:
+                return
+            self._store[key] = encoded
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._store.popitem(last=False)
+                self.size -= len(evicted)
+
+    def encode(self, array, compression=COMPRESSION_NONE, dtype=np.float32):
+        """
+        Encode `array` as :func:`encode_array` would, reusing a previous
+        encoding of identical data when one is still cached.
+        """
+        array = as_encodable_array(array, dtype)
+        key = self.key_for(array, compression, dtype)
+        encoded = self.get(key)
+        if encoded is None:
+            encoded = encode_array(array, compression=compression, dtype=dtype)
+            self.put(key, encoded)
+        return encoded
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / float(total)
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._store)
+
+    def __repr__(self):
+        return "EncodedArrayCache(max_size=%d, size=%d, hits=%d, misses=%d)" % (
+            self.max_size, self.size, self.hits, self.misses)
+
+
+# --------------------------------------------------
+# Codec Policies
+
+
+class CodecPolicy(object):
+    """
+    Chooses the compression to use for each array as it is encoded,
+    in place of a single compression applied to every array.
+    """
+    def select(self, array, dtype=np.float32, array_type=None):
+        """
+        Choose the compression for `array`.
+
+        Parameters
+        ----------
+        array : array-like
+            The values to be encoded
+        dtype : type, optional
+            The type `array` will be encoded as
+        array_type : str, optional
+            The kind of array, such as "m/z array"
+
+        Returns
+        -------
+        str
+            The compression to encode `array` with
+        """
+        raise NotImplementedError()
+
+    def __call__(self, array, dtype=np.float32, array_type=None):
+        return self.select(array, dtype, array_type)
+
+
+class FixedCodecPolicy(CodecPolicy):
+    """
+    Always chooses the same compression.
+    """
+    def __init__(self, compression=COMPRESSION_ZLIB):
+        self.compression = compression
+
+    def select(self, array, dtype=np.float32, array_type=None):
+        return self.compression
+
+    def __repr__(self):
+        return "FixedCodecPolicy(%r)" % (self.compression,)
+
+
+class MinimumSizeCodecPolicy(CodecPolicy):
+    """
+    Chooses `compression` for arrays of at least `min_points` points and
+    `fallback` for anything smaller, where compression overhead outweighs
+    what it saves.
+    """
+    def __init__(self, compression=COMPRESSION_ZLIB, min_points=64, fallback=COMPRESSION_NONE):
+        self.compression = compression
+        self.min_points = min_points
+        self.fallback = fallback
+
+    def select(self, array, dtype=np.float32, array_type=None):
+        if len(array) >= self.min_points:
+            return self.compression
+        return self.fallback
+
+    def __repr__(self):
+        return "MinimumSizeCodecPolicy(%r, %r, %r)" % (self.compression, self.min_points, self.fallback)
+
+
+class SmallestCodecPolicy(CodecPolicy):
+    """
+    Chooses whichever of `candidates` encodes a sample of the array into the
+    fewest bytes.
+
+    The sample is a contiguous run of at most `sample_size` points from the middle
+    of the array, so runs of similar values and the spacing between sorted values
+    are preserved, while the cost of choosing stays bounded however large the
+    array is. Arrays no longer than `sample_size` are judged on their full contents.
+
+    Candidates which cannot encode the sample, like MS-Numpress pic given negative
+    values, are skipped. Lossy candidates are only chosen if they are listed.
+    """
+    def __init__(self, candidates=(COMPRESSION_NONE, COMPRESSION_ZLIB), sample_size=256):
+        self.candidates = tuple(candidates)
+        self.sample_size = sample_size
+
+    def sample(self, array):
+        array = np.asanyarray(array)
+        if len(array) <= self.sample_size:
+            return array
+        start = (len(array) - self.sample_size) // 2
+        return array[start:start + self.sample_size]
+
+    def select(self, array, dtype=np.float32, array_type=None):
+        sample = self.sample(array)
+        best = None
+        best_size = None
+        for compression in self.candidates:
+            try:
+                size = len(encode_array(sample, compression=compression, dtype=dtype))
+            except ValueError:
+                continue
+            if best_size is None or size < best_size:
+                best = compression
+                best_size = size
+        if best is None:
+            raise ValueError("None of %r could encode the array" % (self.candidates,))
+        return best
+
+    def __repr__(self):
+        return "SmallestCodecPolicy(%r, %r)" % (self.candidates, self.sample_size)
+
+
+class ArrayTypeCodecPolicy(CodecPolicy):
+    """
+    Delegates to a different policy, or fixed compression, for each array type.
+
+    Parameters
+    ----------
+    policies : Mapping
+        Maps array type, such as "m/z array", to a :class:`CodecPolicy` or compression name
+    default : :class:`CodecPolicy` or str
+        Used for array types missing from `policies`
+    """
+    def __init__(self, policies, default=COMPRESSION_ZLIB):
+        self.policies = dict(policies)
+        self.default = default
+
+    def select(self, array, dtype=np.float32, array_type=None):
+        policy = self.policies.get(array_type, self.default)
+        if isinstance(policy, CodecPolicy):
+            return policy.select(array, dtype, array_type)
+        return policy
+
+    def __repr__(self):
+        return "ArrayTypeCodecPolicy(%r, %r)" % (self.policies, self.default)
+
+
+def select_compression(compression, array, dtype=np.float32, array_type=None):
+    """
+    Resolve `compression` for `array`, consulting it if it is a :class:`CodecPolicy`.
+    """
+    if isinstance(compression, CodecPolicy):
+        return compression.select(array, dtype, array_type)
+    return compression
+
+
+# A multiple of 3 bytes, so base64 encoded chunks concatenate without padding
+DEFAULT_CHUNK_SIZE = 3 * 2 ** 18
+DEFAULT_SPOOL_SIZE = 2 ** 24
+
+
+class StreamingEncodedArray(object):
+    """
+    A binary array encoded in fixed-size slices so that memory use stays
+    bounded no matter how large the array is.
+
+    When compressing, the array is fed through :func:`zlib.compressobj` one slice
+    at a time into a spooled temporary file, which only moves to disk once it
+    outgrows `spool_size`. Iterating over the instance then yields the base64 text
+    in chunks, each aligned to a 3-byte boundary of the compressed stream.
+
+    Attributes
+    ----------
+    compression : str
+        Either :const:`COMPRESSION_NONE` or :const:`COMPRESSION_ZLIB`
+    dtype : np.dtype
+        The type the array was encoded as
+    compressed_length : int
+        The number of bytes after compression, before base64 encoding
+    encoded_length : int
+        The number of base64 characters that iterating yields
+    """
+    def __init__(self, array, compression=COMPRESSION_NONE, dtype=np.float32,
+                 chunk_size=DEFAULT_CHUNK_SIZE, spool_size=DEFAULT_SPOOL_SIZE):
+        if chunk_size % 3 != 0:
+            raise ValueError("chunk_size must be a multiple of 3, got %d" % chunk_size)
+        self.compression = compression
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self._raw = as_encodable_array(array, dtype).view(np.uint8)
+        self._spool = None
+        if compression == COMPRESSION_NONE:
+            self.compressed_length = len(self._raw)
+        elif compression == COMPRESSION_ZLIB:
+            self._spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+            compressor = zlib.compressobj()
+            for i in range(0, len(self._raw), chunk_size):
+                self._spool.write(compressor.compress(array_buffer(self._raw[i:i + chunk_size])))
+            self._spool.write(compressor.flush())
+            self.compressed_length = self._spool.tell()
+            self._raw = None
+        else:
+            raise ValueError("Cannot stream compression: %s" % compression)
+        self.encoded_length = 4 * ((self.compressed_length + 2) // 3)
+
+    def _compressed_chunks(self):
+        if self._spool is None:
+            for i in range(0, len(self._raw), self.chunk_size):
+                yield array_buffer(self._raw[i:i + self.chunk_size])
+        else:
+            self._spool.seek(0)
+            chunk = self._spool.read(self.chunk_size)
+            while chunk:
+                yield chunk
+                chunk = self._spool.read(self.chunk_size)
+
+    def __iter__(self):
+        for chunk in self._compressed_chunks():
+            yield base64.standard_b64encode(chunk)
+
+    def __len__(self):
+        return self.encoded_length
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+
+
+def decode_array(bytestring, compression=COMPRESSION_NONE, dtype=None):
+    """
+    Decode a base64 encoded, possibly compressed, binary array.
+
+    Parameters
+    ----------
+    bytestring : bytes or str
+        The base64 text of the array
+    compression : str, optional
+        Any compression :func:`encode_array` accepts
+    dtype : type, optional
+        The type the array was encoded as. By default, 64-bit floats for
+        MS-Numpress compressions, which always decode to doubles, and 32-bit
+        floats otherwise.
+
+    Returns
+    -------
+    np.ndarray
+        When no decoding step needs to produce new values, this is a read-only view
+        over the decompressed bytes rather than a copy.
+    """
+    if dtype is None:
+        dtype = encoded_dtype(compression, np.float32)
+    if not isinstance(bytestring, bytes):
+        bytestring = bytestring.encode("ascii")
+    decoded_string = base64.standard_b64decode(bytestring)
+    if compression in numpress_codecs:
+        _, decoder, use_zlib = numpress_codecs[compression]
+        if use_zlib:
+            decoded_string = zlib.decompress(decoded_string)
+        return decoder(decoded_string).astype(dtype, copy=False)
+    if compression == COMPRESSION_ZLIB:
         decoded_string = zlib.decompress(decoded_string)
-    else:
+    elif compression != COMPRESSION_NONE:
         raise ValueError("Unknown compression: %s" % compression)
-    array = np.fromstring(decoded_string, dtype=dtype)
+    array = np.frombuffer(decoded_string, dtype=np.dtype(dtype).newbyteorder('<'))
     return array
+
+
+def _decode_job(job):
+    return decode_array(*job)
+
+
+def decode_arrays(payloads, compression=COMPRESSION_NONE, dtype=None, max_workers=None):
+    """
+    Decode many binary arrays at once on a thread pool. zlib and base64
+    release the GIL, so this scales with the number of threads.
+
+    Parameters
+    ----------
+    payloads : Iterable
+        Each item is either the base64 text of an array, decoded with `compression`
+        and `dtype`, or a tuple of (text, compression, dtype)
+    compression : str, optional
+        The compression of payloads which don't specify their own
+    dtype : type, optional
+        The type of payloads which don't specify their own, by default
+        chosen by :func:`decode_array` from their compression
+    max_workers : int, optional
+        The number of threads to use. With 1, or without :mod:`concurrent.futures`,
+        the arrays are decoded serially.
+
+    Returns
+    -------
+    list of np.ndarray
+        The decoded arrays, in the same order as `payloads`
+    """
+    jobs = [
+        (payload, compression, dtype) if isinstance(payload, _text_types) else tuple(payload)
+        for payload in payloads]
+    if max_workers == 1 or ThreadPoolExecutor is None or len(jobs) < 2:
+        return [_decode_job(job) for job in jobs]
+    executor = ThreadPoolExecutor(max_workers)
+    try:
+        return list(executor.map(_decode_job, jobs))
+    finally:
+        executor.shutdown()
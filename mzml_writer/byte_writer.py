@@ -0,0 +1,410 @@
+import io
+import re
+import sys
+
+from lxml import etree
+
+
+_text_type = type(u'')
+
+# Before Python 3.6, lxml sorts keyword attributes passed to `etree.Element`
+# because keyword arguments had no meaningful order
+_ordered_keywords = sys.version_info >= (3, 6)
+
+_text_specials = re.compile(u'[&<>\r]')
+_attribute_specials = re.compile(u'[&<>"\r\n\t]')
+_non_ascii = re.compile(u'[^\x00-\x7f]')
+_plain_bytes = re.compile(b'[&<>\r\x80-\xff]')
+
+# Matches anything which rules out writing a native string attribute value as-is
+if str is bytes:
+    _special_native = re.compile('[&<>"\r\n\t{\x80-\xff]')
+else:
+    _special_native = re.compile(u'[&<>"\r\n\t{\x80-\U0010ffff]')
+
+
+def _native_to_bytes(text):
+    if str is bytes:
+        return text
+    return text.encode('ascii')
+
+_text_entities = {
+    u'&': u'&amp;',
+    u'<': u'&lt;',
+    u'>': u'&gt;',
+    u'\r': u'&#13;',
+}
+
+_attribute_entities = dict(_text_entities)
+_attribute_entities.update({
+    u'"': u'&quot;',
+    u'\n': u'&#10;',
+    u'\t': u'&#9;',
+})
+
+
+def _as_text(value):
+    if isinstance(value, _text_type):
+        return value
+    elif isinstance(value, bytes):
+        return value.decode('utf-8')
+    raise TypeError("Argument must be bytes or unicode, got %r" % type(value).__name__)
+
+
+def _replace_text_entity(match):
+    return _text_entities[match.group()]
+
+
+def _replace_attribute_entity(match):
+    return _attribute_entities[match.group()]
+
+
+def _hex_character_reference(match):
+    return u'&#x%X;' % ord(match.group())
+
+
+def _decimal_character_reference(match):
+    return u'&#%d;' % ord(match.group())
+
+
+_start_tag_references = {}
+
+
+def _start_tag_character_reference(encoding):
+    # libxml2 has written non-ASCII characters in start tag attributes as
+    # hexadecimal or decimal character references, or newer versions encode
+    # them when the encoding allows, so ask the installed one. None means
+    # they are encoded.
+    try:
+        return _start_tag_references[encoding]
+    except KeyError:
+        pass
+    buffer = io.BytesIO()
+    with etree.xmlfile(buffer, encoding=encoding) as xml_file:
+        with xml_file.element('a', b=u'\xe9'):
+            pass
+    rendered = buffer.getvalue()
+    if b'&#x' in rendered:
+        reference = _hex_character_reference
+    elif b'&#' in rendered:
+        reference = _decimal_character_reference
+    else:
+        reference = None
+    _start_tag_references[encoding] = reference
+    return reference
+
+
+def escape_text(text):
+    """
+    Escape character data the way lxml's serializer does.
+
+    Parameters
+    ----------
+    text : str
+
+    Returns
+    -------
+    str
+    """
+    text = _as_text(text)
+    if _text_specials.search(text):
+        text = _text_specials.sub(_replace_text_entity, text)
+    return text
+
+
+def escape_attribute(value):
+    """
+    Escape an attribute value the way lxml's serializer does.
+
+    Parameters
+    ----------
+    value : str
+
+    Returns
+    -------
+    str
+    """
+    value = _as_text(value)
+    if _attribute_specials.search(value):
+        value = _attribute_specials.sub(_replace_attribute_entity, value)
+    return value
+
+
+class _ElementContext(object):
+    __slots__ = ('xml_file', 'end_tag')
+
+    def __init__(self, xml_file, end_tag):
+        self.xml_file = xml_file
+        self.end_tag = end_tag
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        xml_file = self.xml_file
+        xml_file._buffer.append(self.end_tag)
+        xml_file._buffered += len(self.end_tag)
+        if xml_file._buffered >= xml_file.buffer_size:
+            xml_file.flush()
+
+
+class ByteXMLFile(object):
+    """
+    A stand-in for :class:`lxml.etree.xmlfile` which writes pre-escaped byte
+    fragments into a buffer instead of building lxml elements, producing byte for
+    byte the same output as lxml's incremental writer.
+
+    Like :class:`lxml.etree.xmlfile`, this is a context manager, but the object
+    returned by entering it is the instance itself, which provides the same
+    :meth:`element`, :meth:`write` and :meth:`flush` methods as lxml's incremental
+    writer. :meth:`write_empty` writes a childless element without creating it.
+
+    Most tags in a document recur with the same attributes, like the controlled
+    vocabulary parameters of each spectrum, so rendered tags are memoized.
+
+    Attributes
+    ----------
+    output_file : file
+        The writable binary file the document is written to
+    encoding : str
+        The character encoding of the document. Characters it cannot represent in
+        character data are written as character references, as lxml does.
+    buffer_size : int
+        The number of bytes to collect before writing them to :attr:`output_file`
+    max_cached_tags : int
+        The number of rendered tags to remember
+    """
+    def __init__(self, output_file, encoding=None, buffer_size=2 ** 16, max_cached_tags=2 ** 14):
+        self.output_file = output_file
+        self.encoding = encoding or 'ascii'
+        self.buffer_size = buffer_size
+        self.max_cached_tags = max_cached_tags
+        self._buffer = []
+        self._buffered = 0
+        self._start_tags = {}
+        self._empty_tags = {}
+        # Plain ASCII bytes, like base64 text, can be copied straight through
+        self._ascii_compatible = self._encode(u'<a/>') == b'<a/>'
+        self._start_tag_reference = _start_tag_character_reference(self.encoding)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def _write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def _encode(self, text):
+        return text.encode(self.encoding, 'xmlcharrefreplace')
+
+    def _encode_start_tag(self, text):
+        reference = self._start_tag_reference
+        if reference is None:
+            return self._encode(text)
+        if _non_ascii.search(text):
+            text = _non_ascii.sub(reference, text)
+        return text.encode('ascii')
+
+    def _format_attributes(self, items):
+        return u''.join([
+            u' %s="%s"' % (_as_text(key), escape_attribute(value))
+            for key, value in items])
+
+    def _format_plain_attributes(self, items):
+        # The common case of ASCII names and values with nothing to escape,
+        # formatted without any conversion. Returns None for anything else.
+        parts = []
+        for key, value in items:
+            if type(value) is not str or type(key) is not str or _special_native.search(value):
+                return None
+            parts.append(' %s="%s"' % (key, value))
+        return ''.join(parts)
+
+    def _render_start_tag(self, tag, items):
+        attributes = self._format_plain_attributes(items) if type(tag) is str else None
+        if attributes is not None:
+            start_tag = _native_to_bytes('<%s%s>' % (tag, attributes))
+        else:
+            start_tag = u'<%s%s>' % (_as_text(tag), self._format_attributes(items))
+            start_tag = self._encode_start_tag(start_tag)
+        end_tag = u'</%s>' % _as_text(tag)
+        return start_tag, _ElementContext(self, end_tag.encode('ascii'))
+
+    def _render_empty_tag(self, tag, items):
+        attributes = self._format_plain_attributes(items) if type(tag) is str else None
+        if attributes is not None:
+            return _native_to_bytes('<%s%s/>' % (tag, attributes))
+        return self._encode(u'<%s%s/>' % (_as_text(tag), self._format_attributes(items)))
+
+    def text_bytes(self, text):
+        """
+        Escape and encode character data as :meth:`write` would.
+
+        Parameters
+        ----------
+        text : str
+
+        Returns
+        -------
+        bytes
+        """
+        if type(text) is bytes and self._ascii_compatible and not _plain_bytes.search(text):
+            return text
+        return self._encode(escape_text(text))
+
+    def attribute_bytes(self, value, start_tag=False):
+        """
+        Escape and encode an attribute value as it would be rendered in a tag.
+
+        Parameters
+        ----------
+        value : str
+        start_tag : bool, optional
+            Whether the attribute belongs to a start tag written by :meth:`element`,
+            rather than to an empty element
+
+        Returns
+        -------
+        bytes
+        """
+        if type(value) is str and not _special_native.search(value):
+            return _native_to_bytes(value)
+        value = escape_attribute(value)
+        if start_tag:
+            return self._encode_start_tag(value)
+        return self._encode(value)
+
+    def write_bytes(self, data):
+        """
+        Write bytes which are already escaped and encoded.
+
+        Parameters
+        ----------
+        data : bytes
+        """
+        self._write(data)
+
+    def _cached(self, cache, render, tag, items):
+        key = (tag, items)
+        try:
+            return cache[key]
+        except KeyError:
+            rendered = render(tag, items)
+            if len(cache) >= self.max_cached_tags:
+                cache.clear()
+            cache[key] = rendered
+            return rendered
+        except TypeError:
+            return render(tag, items)
+
+    def element(self, tag, attrib=None, nsmap=None, **_extra):
+        """
+        Write the start tag of `tag` and return a context manager
+        which writes the end tag on exit.
+
+        Parameters
+        ----------
+        tag : str
+        attrib : Mapping, optional
+            The attributes of the element, in the order they are to be written
+        nsmap : dict, optional
+            Ignored, accepted for compatibility with lxml
+        **_extra
+            Further attributes
+
+        Returns
+        -------
+        _ElementContext
+        """
+        if attrib:
+            items = tuple(attrib.items()) + tuple(_extra.items())
+        else:
+            items = tuple(_extra.items())
+        try:
+            start_tag, context = self._start_tags[tag, items]
+        except (KeyError, TypeError):
+            start_tag, context = self._cached(self._start_tags, self._render_start_tag, tag, items)
+        self._buffer.append(start_tag)
+        self._buffered += len(start_tag)
+        return context
+
+    def render_empty(self, tag, attrib=None):
+        """
+        Render the bytes :meth:`write_empty` would write.
+
+        Parameters
+        ----------
+        tag : str
+        attrib : dict, optional
+            The attributes of the element
+
+        Returns
+        -------
+        bytes
+        """
+        if not attrib:
+            items = ()
+        elif _ordered_keywords:
+            items = tuple(attrib.items())
+        else:
+            items = tuple(sorted(attrib.items()))
+        return self._cached(self._empty_tags, self._render_empty_tag, tag, items)
+
+    def write_empty(self, tag, attrib=None):
+        """
+        Write a childless element with no text, equivalent to writing
+        ``etree.Element(tag, **attrib)`` with :meth:`write`.
+
+        Parameters
+        ----------
+        tag : str
+        attrib : dict, optional
+            The attributes of the element
+        """
+        self._write(self.render_empty(tag, attrib))
+
+    def write(self, *args, **kwargs):
+        """
+        Write text, which is escaped, or :class:`lxml.etree.Element` objects,
+        which are serialized with :func:`lxml.etree.tostring`.
+
+        Parameters
+        ----------
+        *args : str or lxml.etree.Element
+        with_tail : bool, optional
+            Whether to write the tail text of elements. Defaults to :const:`True`
+        pretty_print : bool, optional
+            Whether to indent elements. Defaults to :const:`False`
+        """
+        with_tail = kwargs.get("with_tail", True)
+        pretty_print = kwargs.get("pretty_print", False)
+        for arg in args:
+            if isinstance(arg, (bytes, _text_type)):
+                self._write(self.text_bytes(arg))
+            elif (not len(arg) and arg.text is None and arg.tail is None and
+                    isinstance(arg.tag, (bytes, _text_type)) and arg.tag[:1] != '{'):
+                # Childless elements are common enough to skip the serializer for
+                tag, items = arg.tag, tuple(arg.items())
+                try:
+                    empty_tag = self._empty_tags[tag, items]
+                except (KeyError, TypeError):
+                    empty_tag = self._cached(self._empty_tags, self._render_empty_tag, tag, items)
+                self._write(empty_tag)
+            else:
+                self._write(etree.tostring(
+                    arg, encoding=self.encoding, xml_declaration=False,
+                    with_tail=with_tail, pretty_print=pretty_print))
+
+    def flush(self):
+        """
+        Write everything buffered so far to :attr:`output_file`.
+        """
+        if self._buffer:
+            self.output_file.write(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
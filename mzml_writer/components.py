@@ -6,21 +6,23 @@ import re
 
 from datetime import datetime
 from numbers import Number as NumberBase
-from itertools import chain
+from itertools import chain, count
 from functools import partial, update_wrapper
-from collections import Mapping
+from array import array
+from bisect import bisect_right
 
 from . import controlled_vocabulary
-from .utils import ensure_iterable
+from .byte_writer import ByteXMLFile
+from .utils import ensure_iterable, basestring, Mapping, with_metaclass
 
 from lxml import etree
 
 
 def make_counter(start=1):
     '''
-    Create a functor whose only internal piece of data is a mutable container
-    with a reference to an integer, `start`. When the functor is called, it returns
-    current `int` value of `start` and increments the mutable value by one.
+    Create a functor whose only internal piece of data is an :func:`itertools.count`
+    starting at `start`. When the functor is called, it returns the next `int` in the
+    count, which is safe to do from several threads.
 
     Parameters
     ----------
@@ -32,13 +34,7 @@ def make_counter(start=1):
     int:
         The next number in the count progression.
     '''
-    start = [start]
-
-    def count_up():
-        ret_val = start[0]
-        start[0] += 1
-        return ret_val
-    return count_up
+    return partial(next, count(start))
 
 
 def camelize(name):
@@ -77,14 +73,14 @@ class CountedType(type):
         return new_type
 
 
-class TagBase(object):
-    __metaclass__ = CountedType
-
+class TagBase(with_metaclass(CountedType, object)):
     type_attrs = {}
 
     def __init__(self, tag_name=None, text="", **attrs):
         self.tag_name = tag_name or self.tag_name
         _id = attrs.pop('id', None)
+        # Ids are numbered per document when created for one
+        context = attrs.pop('context', None)
         self.attrs = {}
         self.attrs.update(self.type_attrs)
         self.text = text
@@ -94,7 +90,7 @@ class TagBase(object):
         # flag won't be propagated. `_force_id` preserves this.
         self._force_id = True
         if _id is None:
-            self._id_number = self.counter()
+            self._id_number = self.counter() if context is None else context.next_id(type(self))
             self._id_string = None
             self._force_id = False
         elif isinstance(_id, int):
@@ -138,21 +134,29 @@ class TagBase(object):
     def with_id(self):
         return False
 
-    def element(self, xml_file=None, with_id=False):
+    def _attributes(self, with_id=False):
         with_id = self.with_id or with_id or self._force_id
         # if self.tag_name == "software" and not with_id:
         #     raise Exception()
         attrs = {k: str(v) for k, v in self.attrs.items() if v is not None}
         if with_id:
             attrs['id'] = self.id
+        return attrs
+
+    def element(self, xml_file=None, with_id=False):
+        attrs = self._attributes(with_id)
         if xml_file is None:
             return etree.Element(self.tag_name, **attrs)
         else:
             return xml_file.element(self.tag_name, **attrs)
 
     def write(self, xml_file, with_id=False):
-        el = self.element(with_id=with_id)
-        xml_file.write(el)
+        if isinstance(xml_file, ByteXMLFile):
+            # Skip building an lxml element just to serialize it
+            xml_file.write_empty(self.tag_name, self._attributes(with_id))
+        else:
+            el = self.element(with_id=with_id)
+            xml_file.write(el)
 
     __call__ = element
 
@@ -189,6 +193,17 @@ class MzML(TagBase):
         super(MzML, self).__init__("mzML", **attrs)
 
 
+class IndexedMzML(TagBase):
+    type_attrs = {
+        "xmlns": "http://psi.hupo.org/ms/mzml",
+        "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+        "xsi:schemaLocation": "http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.2_idx.xsd"
+    }
+
+    def __init__(self, **attrs):
+        super(IndexedMzML, self).__init__("indexedmzML", **attrs)
+
+
 class CVParam(TagBase):
     tag_name = "cvParam"
 
@@ -256,6 +271,50 @@ class UserParam(CVParam):
     tag_name = "userParam"
 
 
+class ConstantParamMixin(object):
+    """
+    A shared, pre-rendered parameter whose attributes never change, like
+    "centroid spectrum" or "zlib compression", written by every spectrum which
+    uses it without being rebuilt. Instances are created and interned by
+    :meth:`VocabularyResolver.param` and must not be modified.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ConstantParamMixin, self).__init__(*args, **kwargs)
+        self._element = super(ConstantParamMixin, self).element()
+        self._rendered = {}
+
+    @property
+    def value(self):
+        return self.attrs.get("value")
+
+    @value.setter
+    def value(self, value):
+        raise AttributeError("%s is constant" % self.__class__.__name__)
+
+    def write(self, xml_file, with_id=False):
+        if with_id:
+            super(ConstantParamMixin, self).write(xml_file, with_id=with_id)
+        elif isinstance(xml_file, ByteXMLFile):
+            try:
+                rendered = self._rendered[xml_file.encoding]
+            except KeyError:
+                rendered = self._rendered[xml_file.encoding] = xml_file.render_empty(
+                    self.tag_name, self._attributes())
+            xml_file.write_bytes(rendered)
+        else:
+            xml_file.write(self._element)
+
+    __call__ = write
+
+
+class ConstantCVParam(ConstantParamMixin, CVParam):
+    _track = NO_TRACK
+
+
+class ConstantUserParam(ConstantParamMixin, UserParam):
+    _track = NO_TRACK
+
+
 class CV(TagBase):
     tag_name = 'cv'
 
@@ -265,8 +324,7 @@ class CV(TagBase):
 
     def load(self, handle=None):
         if handle is None:
-            fp = controlled_vocabulary.obo_cache.resolve(self.uri)
-            cv = controlled_vocabulary.ControlledVocabulary.from_obo(fp)
+            cv = controlled_vocabulary.obo_cache.load_vocabulary(self.uri)
         else:
             cv = controlled_vocabulary.ControlledVocabulary.from_obo(handle)
         try:
@@ -354,12 +412,222 @@ class SpecializedContextCache(dict):
         return '%s\n%s' % (self.type_name, dict.__repr__(self))
 
 
+# Splits an id into a prefix and a trailing number without leading zeros
+_numbered_id_pattern = re.compile(r"^(.*?)(0|[1-9]\d{0,8})$", re.DOTALL)
+
+
+class SpectrumIdRegistry(SpecializedContextCache):
+    """
+    A :class:`SpecializedContextCache` for spectrum ids, which are written for
+    every spectrum and usually refer to themselves.
+
+    Self-referencing ids which end in a number, like ``"scan=1234"``, are stored
+    as runs of consecutive numbers per prefix in :class:`array.array` instances
+    rather than as dictionary entries, so consecutively numbered spectra take
+    almost no space. Other ids are stored in the dictionary as usual.
+    """
+    def __init__(self, type_name):
+        super(SpectrumIdRegistry, self).__init__(type_name)
+        # prefix -> (run starts, run ends)
+        self._runs = {}
+        self._run_count = 0
+
+    def _split(self, key):
+        if not isinstance(key, basestring):
+            return None, None
+        match = _numbered_id_pattern.match(key)
+        if match is None:
+            return None, None
+        return match.group(1), int(match.group(2))
+
+    def _in_runs(self, key):
+        prefix, number = self._split(key)
+        try:
+            starts, ends = self._runs[prefix]
+        except KeyError:
+            return False
+        i = bisect_right(starts, number) - 1
+        return i >= 0 and number <= ends[i]
+
+    def _add_to_runs(self, prefix, number):
+        try:
+            starts, ends = self._runs[prefix]
+        except KeyError:
+            starts, ends = self._runs[prefix] = (array('l'), array('l'))
+        i = bisect_right(starts, number) - 1
+        if i >= 0 and number <= ends[i]:
+            return
+        self._run_count += 1
+        if i >= 0 and ends[i] + 1 == number:
+            ends[i] = number
+            # Join the following run if this closes the gap
+            if i + 1 < len(starts) and starts[i + 1] == number + 1:
+                ends[i] = ends[i + 1]
+                del starts[i + 1]
+                del ends[i + 1]
+        elif i + 1 < len(starts) and starts[i + 1] == number + 1:
+            starts[i + 1] = number
+        else:
+            starts.insert(i + 1, number)
+            ends.insert(i + 1, number)
+
+    def _remove_from_runs(self, prefix, number):
+        starts, ends = self._runs[prefix]
+        i = bisect_right(starts, number) - 1
+        start, end = starts[i], ends[i]
+        self._run_count -= 1
+        if start == end:
+            del starts[i]
+            del ends[i]
+        elif number == start:
+            starts[i] = number + 1
+        elif number == end:
+            ends[i] = number - 1
+        else:
+            # Split the run around the number
+            ends[i] = number - 1
+            starts.insert(i + 1, number + 1)
+            ends.insert(i + 1, end)
+
+    def __setitem__(self, key, value):
+        prefix, number = self._split(key)
+        if prefix is not None:
+            if key == value and not dict.__contains__(self, key):
+                self._add_to_runs(prefix, number)
+                return
+            if self._in_runs(key):
+                # The id now refers to something else, so it leaves its run
+                self._remove_from_runs(prefix, number)
+        dict.__setitem__(self, key, value)
+
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except (KeyError, TypeError):
+            if self._in_runs(key):
+                return key
+        return super(SpectrumIdRegistry, self).__getitem__(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self._in_runs(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __len__(self):
+        return dict.__len__(self) + self._run_count
+
+    def __iter__(self):
+        for key in dict.__iter__(self):
+            yield key
+        for prefix, (starts, ends) in self._runs.items():
+            for start, end in zip(starts, ends):
+                for number in range(start, end + 1):
+                    yield "%s%d" % (prefix, number)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def __repr__(self):
+        return '%s\n%r' % (self.type_name, dict(self.items()))
+
+
 class VocabularyResolver(object):
+    """
+    Resolves parameter names against a list of controlled vocabularies.
+
+    Resolving a name means searching each vocabulary in turn, so :meth:`param`
+    remembers the outcome for each (name, cv_ref, accession) it is given, including
+    names which no vocabulary defines. Parameters without a value are shared as
+    :class:`ConstantCVParam` or :class:`ConstantUserParam` instances. These are
+    forgotten whenever the list of vocabularies is replaced or its members change.
+
+    Attributes
+    ----------
+    vocabularies : list of :class:`CV`
+    resolution_hits : int
+        The number of parameters resolved from the cache
+    resolution_misses : int
+        The number of parameters resolved by searching :attr:`vocabularies`
+    max_resolved_names : int
+        The number of distinct (name, cv_ref, accession) outcomes to remember
+    max_constant_params : int
+        The number of distinct parameters without a value to share
+    """
+    max_resolved_names = 2 ** 12
+    max_constant_params = 2 ** 12
+
     def __init__(self, vocabularies=None):
         if vocabularies is None:
             vocabularies = default_cv_list
         self.vocabularies = vocabularies
 
+    @property
+    def vocabularies(self):
+        return self._vocabularies
+
+    @vocabularies.setter
+    def vocabularies(self, vocabularies):
+        self._vocabularies = vocabularies
+        self.clear_resolution_cache()
+
+    def clear_resolution_cache(self):
+        """
+        Forget every resolved parameter name and reset the hit and miss counts.
+        """
+        self._resolution_cache = {}
+        self._constant_params = {}
+        self._resolved_vocabularies = tuple(self._vocabularies)
+        self.resolution_hits = 0
+        self.resolution_misses = 0
+
+    def _check_vocabularies(self):
+        vocabularies = self._vocabularies
+        resolved_vocabularies = self._resolved_vocabularies
+        if len(vocabularies) != len(resolved_vocabularies) or any(
+                cv is not resolved for cv, resolved in zip(vocabularies, resolved_vocabularies)):
+            self.clear_resolution_cache()
+
+    def _resolve(self, name, cv_ref, accession):
+        # Returns the (name, accession, cv_ref) triple for a parameter with no cv_ref
+        self._check_vocabularies()
+        key = (name, cv_ref, accession)
+        try:
+            resolved = self._resolution_cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable names can still be looked up, just not remembered
+            self.resolution_misses += 1
+            return self._search_vocabularies(name, cv_ref, accession)
+        else:
+            self.resolution_hits += 1
+            return resolved
+        self.resolution_misses += 1
+        if len(self._resolution_cache) >= self.max_resolved_names:
+            self._resolution_cache.clear()
+        resolved = self._resolution_cache[key] = self._search_vocabularies(name, cv_ref, accession)
+        return resolved
+
+    def _search_vocabularies(self, name, cv_ref, accession):
+        for cv in self._vocabularies:
+            try:
+                term = cv[name]
+                name = term["name"]
+                accession = term["id"]
+                cv_ref = cv.id
+            except:
+                pass
+        return name, accession, cv_ref
+
     def get_vocabulary(self, id):
         for vocab in self.vocabularies:
             if vocab.id == id:
@@ -380,21 +648,34 @@ class VocabularyResolver(object):
 
             kwargs.update({k: v for k, v in mapping.items() if k not in ("name", "value", "accession")})
 
+        if value is not None:
+            return self._make_param(name, value, cv_ref, accession, kwargs)
+        self._check_vocabularies()
+        try:
+            key = (name, cv_ref, accession, frozenset(kwargs.items()))
+            param = self._constant_params[key]
+        except KeyError:
+            pass
+        except TypeError:
+            return self._make_param(name, value, cv_ref, accession, kwargs)
+        else:
+            self.resolution_hits += 1
+            return param
+        param = self._make_param(name, value, cv_ref, accession, kwargs, constant=True)
+        if len(self._constant_params) >= self.max_constant_params:
+            self._constant_params.clear()
+        self._constant_params[key] = param
+        return param
+
+    def _make_param(self, name, value, cv_ref, accession, kwargs, constant=False):
         if cv_ref is None:
-            for cv in self.vocabularies:
-                try:
-                    term = cv[name]
-                    name = term["name"]
-                    accession = term["id"]
-                    cv_ref = cv.id
-                except:
-                    pass
+            name, accession, cv_ref = self._resolve(name, cv_ref, accession)
         if cv_ref is None:
-            return UserParam(name=name, value=value, **kwargs)
+            return (ConstantUserParam if constant else UserParam)(name=name, value=value, **kwargs)
         else:
             kwargs.setdefault("ref", cv_ref)
             kwargs.setdefault("accession", accession)
-            return CVParam(name=name, value=value, **kwargs)
+            return (ConstantCVParam if constant else CVParam)(name=name, value=value, **kwargs)
 
     def term(self, name, include_source=False):
         for cv in self.vocabularies:
@@ -411,12 +692,41 @@ class VocabularyResolver(object):
 
 
 class DocumentContext(dict, VocabularyResolver):
+    # Component types whose references are stored in something
+    # more specialized than a SpecializedContextCache
+    cache_types = {
+        "Spectrum": SpectrumIdRegistry,
+    }
+
     def __init__(self, vocabularies=None):
         dict.__init__(self)
         VocabularyResolver.__init__(self, vocabularies)
+        self._id_counters = {}
+
+    def next_id(self, tag_type):
+        """
+        Draw the next id number for an element of `tag_type` in this document.
+
+        Each document numbers its elements independently of any other, and
+        drawing ids from several threads at once is safe.
+
+        Parameters
+        ----------
+        tag_type : type
+            The :class:`TagBase` subclass being numbered
+
+        Returns
+        -------
+        int
+        """
+        try:
+            counter = self._id_counters[tag_type]
+        except KeyError:
+            counter = self._id_counters.setdefault(tag_type, count(1))
+        return next(counter)
 
     def __missing__(self, key):
-        self[key] = SpecializedContextCache(key)
+        self[key] = self.cache_types.get(key, SpecializedContextCache)(key)
         return self[key]
 
 
@@ -429,8 +739,8 @@ class ReprBorrowingPartial(partial):
     `__repr__` method instead of a generic partial
     """
     def __init__(self, func, *args, **kwargs):
+        # The arguments are bound by partial.__new__
         self._func = func
-        super(ReprBorrowingPartial, self).__init__(func, *args, **kwargs)
         update_wrapper(self, func)
 
     def __repr__(self):
@@ -446,6 +756,9 @@ class ComponentDispatcher(object):
     an automatically parameterized version of all :class:`ComponentBase`
     types which use this instance's context.
 
+    Each parameterized constructor is created when first requested and stored
+    in the instance's ``__dict__``, so later lookups are plain attribute access.
+
     Attributes
     ----------
     context : :class:`DocumentContext`
@@ -478,7 +791,8 @@ class ComponentDispatcher(object):
             the :class:`ComponentBase` type requested.
         """
         component = ChildTrackingMeta._cache[name]
-        return ReprBorrowingPartial(component, context=self.context)
+        constructor = self.__dict__[name] = ReprBorrowingPartial(component, context=self.context)
+        return constructor
 
     def register(self, entity_type, id):
         """
@@ -518,9 +832,7 @@ class ComponentDispatcher(object):
 # Base Component Definitions
 
 
-class ComponentBase(object):
-    __metaclass__ = ChildTrackingMeta
-
+class ComponentBase(with_metaclass(ChildTrackingMeta, object)):
     def __init__(self, *args, **kwargs):
         pass
 
@@ -548,7 +860,7 @@ class ParameterContainer(ComponentBase):
     def __init__(self, tag_name, params=None, context=NullMap):
         if params is None:
             params = []
-        self.element = _element(tag_name)
+        self.element = _element(tag_name, context=context)
         self.context = context
         self.params = params
 
@@ -562,7 +874,8 @@ class GenericCollection(ComponentBase):
     def __init__(self, tag_name, members, context=NullMap):
         self.members = members
         self.tag_name = tag_name
-        self.element = _element(tag_name, xmlns="http://psidev.info/psi/pi/mzML/1.1", count=len(self.members))
+        self.element = _element(
+            tag_name, xmlns="http://psidev.info/psi/pi/mzML/1.1", count=len(self.members), context=context)
 
     def write(self, xml_file):
         with self.element.element(xml_file, with_id=False):
@@ -581,7 +894,9 @@ class IDGenericCollection(GenericCollection):
     def __init__(self, tag_name, members, id, context=NullMap):
         self.members = members
         self.tag_name = tag_name
-        self.element = _element(tag_name, xmlns="http://psidev.info/psi/pi/mzML/1.1", id=id, count=len(self.members))
+        self.element = _element(
+            tag_name, xmlns="http://psidev.info/psi/pi/mzML/1.1", id=id, count=len(self.members),
+            context=context)
         context[tag_name][id] = self.element.id
 
     def write(self, xml_file):
@@ -597,7 +912,7 @@ class IDGenericCollection(GenericCollection):
 class FileContent(ComponentBase):
     def __init__(self, spectrum_types, context=NullMap):
         self.spectrum_types = spectrum_types
-        self.element = _element("fileContent")
+        self.element = _element("fileContent", context=context)
         self.context = context
 
     def write(self, xml_file):
@@ -617,7 +932,7 @@ class SourceFile(ComponentBase):
             params = []
         self.location = location
         self.name = name
-        self.element = _element("SourceFile", location=location, id=id, name=name)
+        self.element = _element("SourceFile", location=location, id=id, name=name, context=context)
         self.params = params
         self.context = context
         context["SourceFile"][id] = self.element.id
@@ -640,7 +955,7 @@ class FileDescription(ComponentBase):
         self.source_files = source_files
         self.contacts = contacts
         self.context = context
-        self.element = _element("fileDescription")
+        self.element = _element("fileDescription", context=context)
 
     def write(self, xml_file):
         with self.element.element(xml_file, with_id=False):
@@ -663,7 +978,7 @@ class ReferenceableParamGroup(ComponentBase):
         if params is None:
             params = []
         self.params = params
-        self.element = _element("referenceableParamGroup", id=id)
+        self.element = _element("referenceableParamGroup", id=id, context=context)
         self.id = self.element.id
         self.context = context
         context["ReferenceableParamGroup"][id] = self.element.id
@@ -689,7 +1004,7 @@ class Sample(ComponentBase):
             params = []
         self.name = name
         self.params = params
-        self.element = _element("sample", name=name, id=id)
+        self.element = _element("sample", name=name, id=id, context=context)
         self.id = self.element.id
         self.context = context
 
@@ -713,7 +1028,7 @@ class Software(ComponentBase):
             params = []
         self.version = version
         self.params = params
-        self.element = _element("software", id=id, version=version)
+        self.element = _element("software", id=id, version=version, context=context)
         self.id = self.element.id
         self.context = context
         context['Software'][id] = self.element.id
@@ -748,7 +1063,7 @@ class ScanSettings(ComponentBase):
         self.params = params
         self.source_file_references = source_file_references
         self.target_list = target_list
-        self.element = _element("scanSettings", id=id)
+        self.element = _element("scanSettings", id=id, context=context)
         self.id = self.element.id
         self.context = context
         context['ScanSettings'][id] = self.id
@@ -783,7 +1098,7 @@ class InstrumentConfiguration(ComponentBase):
         self.component_list = component_list
         self.element = _element(
             "instrumentConfiguration", id=id,
-            scanSettingsRef=context['ScanSettings'][scan_settings_reference])
+            scanSettingsRef=context['ScanSettings'][scan_settings_reference], context=context)
         self.context = context
 
     def write(self, xml_file):
@@ -822,7 +1137,7 @@ class Source(ComponentBase):
     def __init__(self, order, params=None, context=NullMap):
         self.order = order
         self.params = params
-        self.element = _element("source", order=order)
+        self.element = _element("source", order=order, context=context)
         self.context = context
 
     def write(self, xml_file):
@@ -835,7 +1150,7 @@ class Analyzer(ComponentBase):
     def __init__(self, order, params=None, context=NullMap):
         self.order = order
         self.params = params
-        self.element = _element("analyzer", order=order)
+        self.element = _element("analyzer", order=order, context=context)
         self.context = context
 
     def write(self, xml_file):
@@ -848,7 +1163,7 @@ class Detector(ComponentBase):
     def __init__(self, order, params=None, context=NullMap):
         self.order = order
         self.params = params
-        self.element = _element("detector", order=order)
+        self.element = _element("detector", order=order, context=context)
         self.context = context
 
     def write(self, xml_file):
@@ -873,7 +1188,7 @@ class DataProcessing(ComponentBase):
         if processing_methods and not isinstance(processing_methods[0], ProcessingMethod):
             processing_methods = [ProcessingMethod(context=context, **m) for m in processing_methods]
         self.processing_methods = processing_methods
-        self.element = _element("dataProcessing", id=id)
+        self.element = _element("dataProcessing", id=id, context=context)
         self.context = context
         context['DataProcessing'][id] = self.element.id
 
@@ -890,7 +1205,7 @@ class ProcessingMethod(ComponentBase):
         self.order = order
         self.software_reference = software_reference
         self._software_reference = context['Software'][software_reference]
-        self.element = _element("processingMethod", order=order, softwareRef=self._software_reference)
+        self.element = _element("processingMethod", order=order, softwareRef=self._software_reference, context=context)
         self.params = params
         self.context = context
 
@@ -909,7 +1224,8 @@ class SpectrumList(ComponentBase):
         self.default_data_processing_reference = default_data_processing_reference
         self._default_data_processing_reference = context["DataProcessing"][default_data_processing_reference]
         self.element = _element(
-            "spectrumList", count=len(self.members), defaultDataProcessingRef=self._default_data_processing_reference)
+            "spectrumList", count=len(self.members),
+            defaultDataProcessingRef=self._default_data_processing_reference, context=context)
         self.context = context
 
     def write(self, xml_file):
@@ -937,7 +1253,8 @@ class Spectrum(ComponentBase):
         self._data_processing_reference = context["DataProcessing"][data_processing_reference]
         self.element = _element(
             "spectrum", id=id, index=index, sourceFileRef=self._source_file_reference,
-            defaultArrayLength=self.default_array_length, dataProcessingRef=self._data_processing_reference)
+            defaultArrayLength=self.default_array_length, dataProcessingRef=self._data_processing_reference,
+            context=context)
         self.context = context
         self.context["Spectrum"][id] = self.element.id
         self.params = params
@@ -954,6 +1271,34 @@ class Spectrum(ComponentBase):
             self.binary_data_list.write(xml_file)
 
 
+class Chromatogram(ComponentBase):
+    def __init__(self, index, binary_data_list=None, precursor=None, default_array_length=None,
+                 data_processing_reference=None, id=None, params=None, context=NullMap):
+        if params is None:
+            params = []
+        self.index = index
+        self.precursor = precursor
+        self.binary_data_list = binary_data_list
+        self.default_array_length = default_array_length
+        self.data_processing_reference = data_processing_reference
+        self._data_processing_reference = context["DataProcessing"][data_processing_reference]
+        self.element = _element(
+            "chromatogram", id=id, index=index, defaultArrayLength=self.default_array_length,
+            dataProcessingRef=self._data_processing_reference, context=context)
+        self.context = context
+        self.context["Chromatogram"][id] = self.element.id
+        self.params = params
+
+    def write(self, xml_file):
+        with self.element.element(xml_file, with_id=True):
+            for param in self.params:
+                self.context.param(param)(xml_file)
+            if self.precursor is not None:
+                self.precursor.write(xml_file)
+
+            self.binary_data_list.write(xml_file)
+
+
 class Run(ComponentBase):
     def __init__(self, default_instrument_configuration_reference, spectrum_list=None, chromatogram_list=None, id=None,
                  default_source_file_reference=None, sample_reference=None, start_time_stamp=None, params=None,
@@ -978,7 +1323,7 @@ class Run(ComponentBase):
         self.element = _element(
             "run", id=id, defaultInstrumentConfigurationRef=self._default_instrument_configuration_reference,
             defaultSourceFileRef=self._default_source_file_reference, sampleRef=self._sample_reference,
-            startTimeStamp=start_time_stamp)
+            startTimeStamp=start_time_stamp, context=context)
         self.context = context
 
 
@@ -1001,7 +1346,7 @@ class BinaryDataArray(ComponentBase):
 
         self.element = _element(
             "binaryDataArray", arrayLength=array_length, encodedLength=encoded_length,
-            dataProcessingRef=self._data_processing_reference)
+            dataProcessingRef=self._data_processing_reference, context=context)
         self.context = context
 
     def write(self, xml_file):
@@ -1015,11 +1360,18 @@ class Binary(ComponentBase):
     def __init__(self, encoded_array, context=NullMap):
         self.encoded_array = encoded_array
         self.context = context
-        self.element = _element("binary", text=encoded_array)
+        self.element = _element("binary", text=encoded_array, context=context)
 
     def write(self, xml_file):
         with self.element(xml_file, with_id=False):
-            xml_file.write(self.encoded_array)
+            if isinstance(self.encoded_array, basestring):
+                xml_file.write(self.encoded_array)
+            else:
+                # A StreamingEncodedArray yields its text in chunks, each pushed
+                # out before the next since lxml would otherwise hold all of them
+                for chunk in self.encoded_array:
+                    xml_file.write(chunk)
+                    xml_file.flush()
 
 
 class ScanList(ComponentBase):
@@ -1028,7 +1380,7 @@ class ScanList(ComponentBase):
             params = []
         self.members = members
         self.params = params
-        self.element = _element("scanList", count=len(self.members))
+        self.element = _element("scanList", count=len(self.members), context=context)
         self.context = context
 
     def write(self, xml_file):
@@ -1049,7 +1401,7 @@ class Scan(ComponentBase):
             params = []
         self.params = params
         self.scan_window_list = scan_window_list
-        self.element = _element("scan")
+        self.element = _element("scan", context=context)
         self.context = context
 
     def write(self, xml_file):
@@ -1081,7 +1433,7 @@ class Precursor(ComponentBase):
         self.isolation_window = isolation_window
         self.spectrum_reference = spectrum_reference
         self._spectrum_reference = context["Spectrum"][spectrum_reference]
-        self.element = _element("precursor", spectrumRef=self._spectrum_reference)
+        self.element = _element("precursor", spectrumRef=self._spectrum_reference, context=context)
 
     def write(self, xml_file):
         with self.element.element(xml_file, with_id=False):
@@ -1105,7 +1457,7 @@ class SelectedIon(ComponentBase):
         self.intensity = intensity
         self.charge = charge
         self.params = params
-        self.element = _element("selectedIon")
+        self.element = _element("selectedIon", context=context)
         self.context = context
 
     def write(self, xml_file):
@@ -1145,7 +1497,7 @@ class Person(ComponentBase):
         self.last_name = last_name
         self.id = id
         self.affiliation = affiliation
-        self.element = _element("Person", firstName=first_name, last_name=last_name, id=id)
+        self.element = _element("Person", firstName=first_name, last_name=last_name, id=id, context=context)
         context["Person"][id] = self.element.id
         self.context = context
 
@@ -1158,7 +1510,7 @@ class Organization(ComponentBase):
     def __init__(self, name="name", id=DEFAULT_ORGANIZATION_ID, context=NullMap):
         self.name = name
         self.id = id
-        self.element = _element("Organization", name=name, id=id)
+        self.element = _element("Organization", name=name, id=id, context=context)
         context["Organization"][id] = self.id
         self.context = context
 
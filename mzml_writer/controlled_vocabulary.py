@@ -1,8 +1,19 @@
+import hashlib
+import marshal
 import os
 import re
+import sys
+import tempfile
+import threading
 
 from collections import defaultdict
-from urllib2 import urlopen
+from contextlib import closing
+try:
+    from urllib2 import urlopen
+except ImportError:  # pragma: no cover
+    from urllib.request import urlopen
+
+from .utils import basestring
 
 
 class Reference(object):
@@ -57,7 +68,7 @@ class Relationship(object):
 
     @classmethod
     def fromstring(cls, string):
-        groups = re.search(r"(?P<predicate>\S+):?\s(?P<accession>\S+)\s(?:!\s(?P<comment>.*))", string).groupdict()
+        groups = re.search(r"(?P<predicate>\S+):?\s(?P<accession>\S+)(?:\s!\s(?P<comment>.*))?", string).groupdict()
         return cls(**groups)
 
 
@@ -87,6 +98,48 @@ class Entity(dict):
             return [self.vocabulary[r] for r in reference]
 
 
+class LazyEntity(Entity):
+    """
+    A term of a :class:`LazyControlledVocabulary`, whose :attr:`children`
+    are only looked up when first requested.
+    """
+    def __init__(self, vocabulary=None, **attributes):
+        dict.__init__(self, **attributes)
+        object.__setattr__(self, "vocabulary", vocabulary)
+        object.__setattr__(self, "_children", None)
+
+    @property
+    def children(self):
+        if self._children is None:
+            object.__setattr__(self, "_children", self.vocabulary.children_of(self['id']))
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        object.__setattr__(self, "_children", value)
+
+
+def _pack_entity(entity_type, vocabulary, fields):
+    entity = entity_type(vocabulary, **{k: v[0] if len(v) == 1 else v for k, v in fields.items()})
+    try:
+        is_as = entity['is_a']
+        if isinstance(is_as, basestring):
+            entity['is_a'] = Reference.fromstring(is_as)
+        else:
+            entity['is_a'] = [Reference.fromstring(is_a) for is_a in is_as]
+    except KeyError:
+        pass
+    try:
+        relationships = entity['relationship']
+        if not isinstance(relationships, list):
+            relationships = [relationships]
+        for rel in map(Relationship.fromstring, relationships):
+            entity[rel.predicate] = rel
+    except KeyError:
+        pass
+    return entity
+
+
 class OBOParser(object):
     def __init__(self, handle):
         self.handle = handle
@@ -104,7 +157,7 @@ class OBOParser(object):
                 is_as = Reference.fromstring(is_as)
                 self[is_as].children.append(entity)
             else:
-                is_as = map(Reference.fromstring, is_as)
+                is_as = [Reference.fromstring(is_a) for is_a in is_as]
                 for term in is_as:
                     self[term].children.append(entity)
             entity['is_a'] = is_as
@@ -149,35 +202,205 @@ class OBOParser(object):
         return iter(self.terms.items())
 
 
+def _encode_value(value):
+    if isinstance(value, Reference):
+        return (0, value.accession, value.comment)
+    elif isinstance(value, Relationship):
+        return (1, value.predicate, value.accession, value.comment)
+    elif isinstance(value, list):
+        return [_encode_value(v) for v in value]
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, tuple):
+        if value[0] == 0:
+            return Reference(value[1], value[2])
+        return Relationship(value[1], value[2], value[3])
+    elif isinstance(value, list):
+        return [_decode_value(v) for v in value]
+    return value
+
+
+def _is_plain(value):
+    return not isinstance(value, (Reference, Relationship, list)) or (
+        isinstance(value, list) and not any(isinstance(v, (Reference, Relationship)) for v in value))
+
+
 class ControlledVocabulary(object):
     @classmethod
     def from_obo(cls, handle):
         parser = OBOParser(handle)
         return cls(parser.terms)
 
-    def __init__(self, terms, id=None):
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        Rebuild a vocabulary from the output of :meth:`snapshot`.
+
+        Parameters
+        ----------
+        snapshot : dict
+
+        Returns
+        -------
+        ControlledVocabulary
+        """
+        terms = {}
+        children = []
+        for plain, special, child_ids in snapshot['terms']:
+            entity = Entity()
+            dict.update(entity, plain)
+            for key, value in special:
+                entity[key] = _decode_value(value)
+            terms[entity['id']] = entity
+            children.append((entity, child_ids))
+        for entity, child_ids in children:
+            entity.children.extend([terms[i] for i in child_ids])
+        names = {name: terms[id] for name, id in snapshot['names'].items()}
+        vocabulary = cls(terms, id=snapshot['id'], names=names, normalized=snapshot['normalized'])
+        vocabulary._ancestors = {
+            term_id: frozenset(ancestors) for term_id, ancestors in snapshot['ancestors'].items()}
+        return vocabulary
+
+    def __init__(self, terms, id=None, names=None, normalized=None):
         self.terms = terms
+        self._ancestors = {}
         for term in terms.values():
             term.vocabulary = self
-        self._names = {
-            v['name']: v for v in terms.values()
-        }
-        self._normalized = {
-            v['name'].lower(): v['name']
-            for v in terms.values()
-        }
+        if names is None:
+            names = {
+                v['name']: v for v in terms.values()
+            }
+        self._names = names
+        if normalized is None:
+            normalized = {
+                v['name'].lower(): v['name']
+                for v in terms.values()
+            }
+        self._normalized = normalized
         self.id = id
 
+    def snapshot(self):
+        """
+        Reduce this vocabulary to builtin types which :mod:`marshal` can store,
+        from which :meth:`from_snapshot` rebuilds it without parsing its source.
+        The snapshot includes the ancestors of every term.
+
+        Returns
+        -------
+        dict
+        """
+        return {
+            "id": self.id,
+            "terms": self._snapshot_terms(),
+            "names": {name: term['id'] for name, term in self._names.items()},
+            "normalized": self._normalized,
+            "ancestors": self._snapshot_ancestors(),
+        }
+
+    def _snapshot_terms(self):
+        terms = []
+        for term in self.terms.values():
+            plain = {}
+            special = []
+            for key, value in term.items():
+                if _is_plain(value):
+                    plain[key] = value
+                else:
+                    special.append((key, _encode_value(value)))
+            terms.append((plain, special, [child['id'] for child in term.children]))
+        return terms
+
+    def _snapshot_ancestors(self):
+        return {term_id: list(self.ancestors(term_id)) for term_id in self.keys()}
+
+    def _parent_ids(self, term):
+        is_as = term.get('is_a')
+        if is_as is None:
+            return ()
+        if not isinstance(is_as, list):
+            is_as = [is_as]
+        # OBOParser leaves the is_a references of a term defined before its
+        # parent unparsed
+        return [
+            is_a.accession if isinstance(is_a, Reference) else Reference.fromstring(is_a).accession
+            for is_a in is_as]
+
+    def ancestors(self, key):
+        """
+        Find every term `key` is a kind of, following ``is_a`` references
+        transitively. Each term's ancestors are computed once and remembered,
+        and are stored in snapshots.
+
+        Parameters
+        ----------
+        key : str
+            The id or name of a term
+
+        Returns
+        -------
+        frozenset of str
+            The ids of the ancestors, not including the term itself
+        """
+        term_id = self[key]['id']
+        try:
+            return self._ancestors[term_id]
+        except KeyError:
+            pass
+        # Walked without recursion, visiting each term once, so that an is_a
+        # cycle in a malformed OBO file ends the walk instead of looping forever
+        ancestors = set()
+        pending = list(self._parent_ids(self[term_id]))
+        while pending:
+            parent_id = pending.pop()
+            if parent_id in ancestors:
+                continue
+            ancestors.add(parent_id)
+            try:
+                ancestors.update(self._ancestors[parent_id])
+                continue
+            except KeyError:
+                pass
+            try:
+                pending.extend(self._parent_ids(self[parent_id]))
+            except KeyError:
+                # A reference to a term outside this vocabulary
+                pass
+        ancestors.discard(term_id)
+        ancestors = self._ancestors[term_id] = frozenset(ancestors)
+        return ancestors
+
+    def is_a(self, descendant, ancestor):
+        """
+        Check whether `descendant` is `ancestor` or a kind of it, after the
+        first query about `descendant` in constant time.
+
+        Parameters
+        ----------
+        descendant : str
+            The id or name of a term
+        ancestor : str
+            The id or name of a term
+
+        Returns
+        -------
+        bool
+        """
+        descendant_id = self[descendant]['id']
+        ancestor_id = self[ancestor]['id']
+        return descendant_id == ancestor_id or ancestor_id in self.ancestors(descendant_id)
+
     def __getitem__(self, key):
         try:
             return self.terms[key]
-        except KeyError, e:
+        except KeyError as e:
             try:
                 return self._names[key]
             except KeyError:
                 try:
                     return self._names[self.normalize_name(key)]
-                except KeyError, e2:
+                except KeyError as e2:
                     raise KeyError("%s and %s were not found." % (e, e2))
 
     def __iter__(self):
@@ -196,12 +419,283 @@ class ControlledVocabulary(object):
         return self._normalized[name.lower()]
 
 
+_stanza_line_pattern = re.compile(br"^\[([^\]]+)\]")
+
+_field_line_pattern = re.compile(br"^(id|name|is_a):[ \t]*([^\r\n]*?)[ \t\r\n]*$")
+
+_is_a_value_pattern = re.compile(br"^[^\s!]+")
+
+
+if str is bytes:
+    def _text(value):
+        return value
+else:
+    def _text(value):
+        return value.decode('utf-8')
+
+
+def _binary_source(handle):
+    """
+    Provide the contents of `handle` as a seekable binary file.
+
+    A file on disk is reopened in binary mode, and anything else, like a
+    download or a file-like object in memory, is copied to a temporary file.
+
+    Parameters
+    ----------
+    handle : file
+        A file, in binary or text mode
+
+    Returns
+    -------
+    file
+    """
+    name = getattr(handle, "name", None)
+    if isinstance(name, basestring) and os.path.isfile(name):
+        return open(name, 'rb')
+    source = tempfile.TemporaryFile()
+    while True:
+        chunk = handle.read(2 ** 20)
+        if not chunk:
+            break
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        source.write(chunk)
+    source.seek(0)
+    return source
+
+
+class LazyControlledVocabulary(ControlledVocabulary):
+    """
+    A :class:`ControlledVocabulary` which only indexes the id, name and byte
+    offsets of each term when created, and reads a term from the OBO file and
+    parses it into a :class:`LazyEntity` when it is first looked up. Loading it
+    costs a single scan of the OBO file, and the memory it uses grows with the
+    number of terms used, not the size of the vocabulary.
+
+    The OBO file is kept open to read terms from until :meth:`close` is called.
+
+    Attributes
+    ----------
+    terms : dict
+        The terms parsed so far, by id
+    """
+    @classmethod
+    def from_obo(cls, handle):
+        return cls(_binary_source(handle))
+
+    def __init__(self, source, id=None):
+        self._source = source
+        self._lock = threading.Lock()
+        self._spans = spans = {}
+        self._names = names = {}
+        self._children = None
+        self.terms = {}
+        self._ancestors = {}
+        self.id = id
+        term_id = name = None
+        in_term = False
+        body_start = offset = 0
+        source.seek(0)
+        for line in iter(source.readline, b""):
+            if line.startswith(b"["):
+                stanza = _stanza_line_pattern.match(line)
+                if stanza is not None:
+                    if term_id is not None:
+                        spans[term_id] = (body_start, offset)
+                        if name is not None:
+                            names[name] = term_id
+                    term_id = name = None
+                    in_term = stanza.group(1) == b"Term"
+                    body_start = offset + len(line)
+            elif in_term and (term_id is None or name is None):
+                field = _field_line_pattern.match(line)
+                if field is not None:
+                    key, value = field.groups()
+                    if key == b"id" and term_id is None:
+                        term_id = _text(value)
+                    elif key == b"name" and name is None:
+                        name = _text(value)
+            offset += len(line)
+        if term_id is not None:
+            spans[term_id] = (body_start, offset)
+            if name is not None:
+                names[name] = term_id
+        self._normalized = {
+            name.lower(): name for name in names
+        }
+
+    def _read(self, start, end):
+        # Terms may be looked up from several threads at once
+        with self._lock:
+            self._source.seek(start)
+            return self._source.read(end - start)
+
+    def close(self):
+        """
+        Close the OBO file terms are read from. Terms parsed before
+        remain available.
+        """
+        self._source.close()
+
+    def _materialize(self, term_id):
+        try:
+            return self.terms[term_id]
+        except KeyError:
+            pass
+        start, end = self._spans[term_id]
+        fields = defaultdict(list)
+        for line in _text(self._read(start, end)).splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            key, sep, val = line.partition(":")
+            fields[key].append(val.strip())
+        entity = self.terms[term_id] = _pack_entity(LazyEntity, self, fields)
+        return entity
+
+    def children_of(self, term_id):
+        """
+        Find the terms which are directly a kind of `term_id`.
+
+        The first call reads the OBO file again for every ``is_a`` line.
+
+        Parameters
+        ----------
+        term_id : str
+
+        Returns
+        -------
+        list of :class:`LazyEntity`
+        """
+        if self._children is None:
+            children = defaultdict(list)
+            current = None
+            in_term = False
+            with self._lock:
+                source = self._source
+                source.seek(0)
+                for line in iter(source.readline, b""):
+                    if line.startswith(b"["):
+                        stanza = _stanza_line_pattern.match(line)
+                        if stanza is not None:
+                            current = None
+                            in_term = stanza.group(1) == b"Term"
+                        continue
+                    field = _field_line_pattern.match(line) if in_term else None
+                    if field is None:
+                        continue
+                    key, value = field.groups()
+                    if key == b"id":
+                        if current is None:
+                            current = _text(value)
+                    elif key == b"is_a" and current is not None:
+                        parent = _is_a_value_pattern.match(value)
+                        if parent is not None:
+                            children[_text(parent.group())].append(current)
+            self._children = children
+        return [self._materialize(child) for child in self._children.get(term_id, ())]
+
+    def __getitem__(self, key):
+        try:
+            return self.terms[key]
+        except KeyError:
+            pass
+        try:
+            return self._materialize(key)
+        except KeyError as e:
+            try:
+                return self._materialize(self._names[key])
+            except KeyError:
+                try:
+                    return self._materialize(self._names[self.normalize_name(key)])
+                except KeyError as e2:
+                    raise KeyError("%s and %s were not found." % (e, e2))
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def keys(self):
+        return self._spans.keys()
+
+    def items(self):
+        return [(term_id, self._materialize(term_id)) for term_id in self._spans]
+
+    def snapshot(self):
+        for term_id in self._spans:
+            self._materialize(term_id)
+        return {
+            "id": self.id,
+            "terms": self._snapshot_terms(),
+            "names": dict(self._names),
+            "normalized": self._normalized,
+            "ancestors": self._snapshot_ancestors(),
+        }
+
+
+_data_version_pattern = re.compile(br"^data-version:[ \t]*(.*?)\s*$", re.MULTILINE)
+
+# Bumped whenever the layout of ControlledVocabulary.snapshot changes
+SNAPSHOT_FORMAT = 2
+
+
+# Snapshots are marshalled, whose format changes between Python versions,
+# so each version keeps its own
+_snapshot_suffix = ".snapshot-py%d%d" % sys.version_info[:2]
+
+
+def snapshot_key(content):
+    """
+    Identify the contents of an OBO file, to check a snapshot of
+    the vocabulary parsed from it is still current.
+
+    Parameters
+    ----------
+    content : bytes or str
+        The contents of the OBO file, encoded as UTF-8 if it is text
+
+    Returns
+    -------
+    tuple
+        The snapshot format and Python version, the data-version of the
+        file's header and the SHA-1 digest of its contents
+    """
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    header = content[:content.find(b"[Term]")]
+    match = _data_version_pattern.search(header)
+    data_version = match.group(1) if match else None
+    return ((SNAPSHOT_FORMAT, sys.version_info[0]), data_version,
+            hashlib.sha1(content).hexdigest())
+
+
 class OBOCache(object):
-    def __init__(self, cache_path='.obo_cache', enabled=True, resolvers=None):
+    """
+    Downloads and stores OBO files, and snapshots of the vocabularies parsed
+    from them which are faster to load than parsing the files again.
+
+    Attributes
+    ----------
+    cache_path : str
+        The directory files are stored in
+    enabled : bool
+        Whether to store files at all
+    resolvers : dict
+        Functions providing a file handle for particular URIs instead of downloading them
+    snapshots : bool
+        Whether :meth:`load_vocabulary` stores snapshots of vocabularies it parses
+    lazy : bool
+        Whether :meth:`load_vocabulary` loads :class:`LazyControlledVocabulary`
+        instances, which need neither parsing nor snapshots up front
+    """
+    def __init__(self, cache_path='.obo_cache', enabled=True, resolvers=None, snapshots=True,
+                 lazy=False):
         self.cache_path = cache_path
         self.cache_exists = os.path.exists(cache_path)
         self.enabled = enabled
         self.resolvers = resolvers or {}
+        self.snapshots = snapshots
+        self.lazy = lazy
 
     def path_for(self, name, setext=True):
         if not self.cache_exists:
@@ -230,12 +724,65 @@ class OBOCache(object):
         else:
             return urlopen(uri)
 
+    def load_vocabulary(self, uri):
+        """
+        Load the vocabulary at `uri` from its snapshot when it is up to date with
+        the OBO file, and otherwise parse the file and snapshot the result. When
+        :attr:`lazy` is set, index the file instead.
+
+        Parameters
+        ----------
+        uri : str
+
+        Returns
+        -------
+        ControlledVocabulary
+        """
+        handle = self.resolve(uri)
+        if self.lazy:
+            with closing(handle):
+                return LazyControlledVocabulary.from_obo(handle)
+        if not (self.enabled and self.snapshots) or uri in self.resolvers:
+            return ControlledVocabulary.from_obo(handle)
+        with handle:
+            content = handle.read()
+        key = snapshot_key(content)
+        snapshot_path = self.path_for(uri) + _snapshot_suffix
+        try:
+            # Unmarshalling from bytes is much faster than from a file, which
+            # is read a few bytes at a time
+            with open(snapshot_path, 'rb') as fh:
+                stored_key, snapshot = marshal.loads(fh.read())
+            if stored_key == key:
+                return ControlledVocabulary.from_snapshot(snapshot)
+        except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+            pass
+        cv = ControlledVocabulary.from_obo(content.splitlines())
+        # Written to a temporary file of its own first so that concurrent
+        # writers, in other processes or threads, never read a partial snapshot
+        try:
+            fd, temporary_path = tempfile.mkstemp(
+                prefix=os.path.basename(snapshot_path) + ".",
+                dir=os.path.dirname(snapshot_path) or ".")
+        except (IOError, OSError):
+            return cv
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                marshal.dump((key, cv.snapshot()), fh)
+            os.rename(temporary_path, snapshot_path)
+        except (IOError, OSError):
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+        return cv
+
     def set_resolver(self, uri, provider):
         self.resolvers[uri] = provider
 
     def __repr__(self):
-        return "OBOCache(cache_path=%r, enabled=%r, resolvers=%s)" % (
-            self.cache_path, self.enabled, self.resolvers)
+        return "OBOCache(cache_path=%r, enabled=%r, resolvers=%s, snapshots=%r, lazy=%r)" % (
+            self.cache_path, self.enabled, self.resolvers, self.snapshots, self.lazy)
 
 
 obo_cache = OBOCache()
@@ -0,0 +1,103 @@
+from .writer import MzMLWriter
+
+
+def _deferred(name):
+    def method(self, *args, **kwargs):
+        return self._defer(getattr(self.mzml_writer, name), args, kwargs)
+    method.__name__ = name
+    method.__doc__ = """
+        Defer a call to :meth:`.MzMLWriter.%s` with these arguments until
+        the calls made before it have been carried out.
+        """ % name
+    return method
+
+
+class DeferredElement(object):
+    """
+    The start and end tags of an element written by deferred calls, which
+    remembers whether the start tag was written so that only then is the
+    end tag written.
+    """
+    def __init__(self, mzml_writer, element_name, kwargs):
+        self.mzml_writer = mzml_writer
+        self.element_name = element_name
+        self.kwargs = kwargs
+        self.entered = []
+
+    def enter(self):
+        context = self.mzml_writer.element(self.element_name, **self.kwargs)
+        context.__enter__()
+        self.entered.append(context)
+
+    def exit(self):
+        if self.entered:
+            self.entered.pop().__exit__(None, None, None)
+
+
+class DeferredMzMLWriter(object):
+    """
+    The part of :class:`~.ThreadedMzMLWriter` and :class:`~.AsyncMzMLWriter` which
+    does not depend on how calls are handed to the thread carrying them out.
+
+    Subclasses implement :meth:`_defer`, and carry out each call it is given with
+    :meth:`_carry_out`, in the order they were given. Once a call fails, the calls
+    following it are discarded unless they are marked `always`, which is the case
+    for closing elements and the document, and the error is kept to be raised by
+    :meth:`_raise_error`.
+
+    Attributes
+    ----------
+    mzml_writer : :class:`~.MzMLWriter`
+        The writer the deferred calls are carried out by. It must not be used
+        directly while calls are being carried out.
+    """
+    def __init__(self, outfile, **kwargs):
+        self.mzml_writer = MzMLWriter(outfile, **kwargs)
+        self._error = None
+
+    def _defer(self, func, args=(), kwargs=None, always=False):
+        """
+        Hand ``func(*args, **kwargs)`` to be carried out after the calls before it,
+        first raising the error from any which failed unless `always` is set.
+        """
+        raise NotImplementedError()
+
+    def _carry_out(self, func, args, kwargs, always):
+        if self._error is None or always:
+            try:
+                func(*args, **(kwargs or {}))
+            except BaseException as error:
+                if self._error is None:
+                    self._error = error
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _flush_writer(self):
+        writer = self.mzml_writer.writer
+        if writer is not None:
+            writer.flush()
+
+    def _open_document(self):
+        return self._defer(self.mzml_writer.__enter__)
+
+    def _close_document(self, exc_type, exc_value, traceback):
+        # Closing the document always happens, so that whatever was written
+        # before an error is well formed
+        return self._defer(
+            self.mzml_writer.__exit__, (exc_type, exc_value, traceback), always=True)
+
+    def _open_element(self, element):
+        return self._defer(element.enter)
+
+    def _close_element(self, element):
+        # Like closing the document, closing elements always happens
+        return self._defer(element.exit, always=True)
+
+    write = _deferred("write")
+    controlled_vocabularies = _deferred("controlled_vocabularies")
+    software_list = _deferred("software_list")
+    write_spectrum = _deferred("write_spectrum")
+    write_spectra = _deferred("write_spectra")
+    write_chromatogram = _deferred("write_chromatogram")
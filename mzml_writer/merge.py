@@ -0,0 +1,323 @@
+import mmap
+import re
+
+from .components import element, IndexedMzML
+from .utils import basestring
+from .writer import MzMLWriter
+
+
+_mzml_start = b'<mzML'
+_mzml_end = b'</mzML>'
+_spectrum_list_end = b'</spectrumList>'
+_spectrum_list_pattern = re.compile(br'<spectrumList\b[^>]*>')
+_chromatogram_list_end = b'</chromatogramList>'
+_chromatogram_list_pattern = re.compile(br'<chromatogramList\b[^>]*>')
+# Markup characters are always escaped in text and attribute values, so
+# a start tag is the only place these can match
+_spectrum_pattern = re.compile(br'<spectrum\s[^>]*>')
+_chromatogram_pattern = re.compile(br'<chromatogram\s[^>]*>')
+_index_attribute_pattern = re.compile(br'\sindex="(\d*)"')
+_count_attribute_pattern = re.compile(br'\scount="(\d*)"')
+_id_attribute_pattern = re.compile(br'\sid="([^"]*)"')
+
+_reference_pattern = re.compile(u'&(?:#x([0-9a-fA-F]+)|#([0-9]+)|(amp|lt|gt|quot|apos));')
+_named_references = {u'amp': u'&', u'lt': u'<', u'gt': u'>', u'quot': u'"', u'apos': u"'"}
+
+try:
+    _unichr = unichr
+except NameError:  # pragma: no cover
+    _unichr = chr
+
+
+def _replace_reference(match):
+    hexadecimal, decimal, name = match.groups()
+    if name is not None:
+        return _named_references[name]
+    return _unichr(int(hexadecimal, 16) if hexadecimal is not None else int(decimal))
+
+
+def _unescape_attribute(value):
+    value = value.decode('utf-8')
+    if u'&' in value:
+        value = _reference_pattern.sub(_replace_reference, value)
+    return value
+
+
+def _replace_attribute(tag, match, value):
+    return tag[:match.start(1)] + value + tag[match.end(1):]
+
+
+def _list_start_tag(tag, count):
+    # The merged list is written with an end tag, even when it is empty
+    if tag.endswith(b'/>'):
+        tag = tag[:-2] + b'>'
+    count_match = _count_attribute_pattern.search(tag)
+    if count_match is not None:
+        tag = _replace_attribute(tag, count_match, str(count).encode('ascii'))
+    return tag
+
+
+class _Shard(object):
+    """
+    Locates the parts of an mzML document written by :class:`~.MzMLWriter`
+    which :func:`merge_shards` copies, without parsing it.
+
+    Attributes
+    ----------
+    path : str
+    data : mmap.mmap
+        The contents of the file
+    start : int
+        The position of the ``<mzML>`` start tag
+    spectrum_list_tag : re.Match
+        The ``<spectrumList>`` start tag
+    spectra_start, spectra_end : int
+        The bounds of the spectra in the spectrum list
+    tail_start : int
+        The position following the spectrum list
+    chromatogram_list_tag : re.Match
+        The ``<chromatogramList>`` start tag, or :const:`None` if there is none
+    chromatograms_start, chromatograms_end : int
+        The bounds of the chromatograms in the chromatogram list
+    chromatogram_tail_start : int
+        The position following the chromatogram list
+    end : int
+        The position following the ``</mzML>`` end tag
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as handle:
+            self.data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+        self.start = data.find(_mzml_start)
+        match = _spectrum_list_pattern.search(data, max(self.start, 0))
+        if self.start == -1 or match is None:
+            raise ValueError("%r does not contain a spectrum list" % (path,))
+        self.spectrum_list_tag = match
+        self.spectra_start = match.end()
+        if match.group().endswith(b'/>'):
+            self.spectra_end = self.tail_start = match.end()
+        else:
+            self.spectra_end = data.find(_spectrum_list_end, self.spectra_start)
+            if self.spectra_end == -1:
+                raise ValueError("The spectrum list of %r is incomplete" % (path,))
+            self.tail_start = self.spectra_end + len(_spectrum_list_end)
+        self.end = data.find(_mzml_end, self.tail_start)
+        if self.end == -1:
+            raise ValueError("%r is incomplete" % (path,))
+        self.end += len(_mzml_end)
+        match = _chromatogram_list_pattern.search(data, self.tail_start, self.end)
+        self.chromatogram_list_tag = match
+        if match is None:
+            self.chromatograms_start = self.chromatograms_end = self.tail_start
+            self.chromatogram_tail_start = self.tail_start
+        elif match.group().endswith(b'/>'):
+            self.chromatograms_start = self.chromatograms_end = match.end()
+            self.chromatogram_tail_start = match.end()
+        else:
+            self.chromatograms_start = match.end()
+            self.chromatograms_end = data.find(_chromatogram_list_end, match.end(), self.end)
+            if self.chromatograms_end == -1:
+                raise ValueError("The chromatogram list of %r is incomplete" % (path,))
+            self.chromatogram_tail_start = self.chromatograms_end + len(_chromatogram_list_end)
+
+    def _ids(self, pattern, start, end):
+        ids = []
+        for match in pattern.finditer(self.data, start, end):
+            id_match = _id_attribute_pattern.search(match.group())
+            ids.append(_unescape_attribute(id_match.group(1)) if id_match is not None else None)
+        return ids
+
+    def spectrum_ids(self):
+        return self._ids(_spectrum_pattern, self.spectra_start, self.spectra_end)
+
+    def chromatogram_ids(self):
+        return self._ids(_chromatogram_pattern, self.chromatograms_start, self.chromatograms_end)
+
+    def close(self):
+        self.data.close()
+
+
+class _ShardCopier(object):
+    """
+    Streams pieces of shards into the merged document, recording the offsets
+    of the spectra and chromatograms it copies when it is given offset indices.
+    """
+    def __init__(self, outfile, spectrum_offset_index, chromatogram_offset_index,
+                 chunk_size=2 ** 20):
+        self.outfile = outfile
+        self.spectrum_offset_index = spectrum_offset_index
+        self.chromatogram_offset_index = chromatogram_offset_index
+        self.chunk_size = chunk_size
+        self.spectrum_count = 0
+        self.chromatogram_count = 0
+
+    def copy(self, data, start, end):
+        chunk_size = self.chunk_size
+        write = self.outfile.write
+        while start < end:
+            write(data[start:min(start + chunk_size, end)])
+            start += chunk_size
+
+    def _copy_tags(self, data, start, end, pattern, offset_index, index):
+        """
+        Copy the elements matching `pattern` between `start` and `end`, numbering
+        them from `index` on, and return the index following the last of them.
+        Their offsets are only recorded when there is an `offset_index`, so an
+        unindexed document can be written to a file which cannot tell its position.
+        """
+        outfile = self.outfile
+        last = start
+        for match in pattern.finditer(data, start, end):
+            self.copy(data, last, match.start())
+            tag = match.group()
+            index_match = _index_attribute_pattern.search(tag)
+            if index_match is not None:
+                tag = _replace_attribute(tag, index_match, str(index).encode('ascii'))
+            index += 1
+            if offset_index is not None:
+                id_match = _id_attribute_pattern.search(tag)
+                if id_match is not None:
+                    offset_index.add(_unescape_attribute(id_match.group(1)), outfile.tell())
+            outfile.write(tag)
+            last = match.end()
+        self.copy(data, last, end)
+        return index
+
+    def copy_spectra(self, shard):
+        self.spectrum_count = self._copy_tags(
+            shard.data, shard.spectra_start, shard.spectra_end, _spectrum_pattern,
+            self.spectrum_offset_index, self.spectrum_count)
+
+    def copy_chromatograms(self, shard):
+        self.chromatogram_count = self._copy_tags(
+            shard.data, shard.chromatograms_start, shard.chromatograms_end,
+            _chromatogram_pattern, self.chromatogram_offset_index, self.chromatogram_count)
+
+
+def _count_unique(shards, kind, ids_of):
+    """
+    Count the elements of one kind in every shard, checking
+    that no two of them have the same id.
+    """
+    found_in = {}
+    count = 0
+    for shard in shards:
+        for id in ids_of(shard):
+            count += 1
+            if id is None:
+                continue
+            if id in found_in:
+                raise ValueError("The %s id %r appears in both %r and %r" % (
+                    kind, id, found_in[id], shard.path))
+            found_in[id] = shard.path
+    return count
+
+
+def merge_shards(shard_paths, output, indexed=True, chunk_size=2 ** 20):
+    """
+    Concatenate the spectrum and chromatogram lists of several mzML documents, each
+    holding one shard of a run, into a single document.
+
+    Each shard is an mzML document written by :class:`~.MzMLWriter`, indexed or not,
+    whose spectra are in a ``<spectrumList>``. The merged document has the header
+    of the first shard, then the spectra of every shard in the order given, then
+    their chromatograms, with their ``index`` attributes renumbered and the lists'
+    ``count`` corrected. Everything else is taken from the first shard.
+
+    Ids must be unique across the shards. A writer numbers spectra and chromatograms
+    without an explicit id, like ``SPECTRUM_1``, within its own shard, so those are
+    repeated in every shard; merging shards which share an id raises a
+    :class:`ValueError` before anything is written. Each shard should use ids which
+    identify the spectrum in the run, like ``scan=1234``.
+
+    References between spectra, like a precursor's ``spectrumRef``, are copied as
+    they are. A shard's writer does not know the spectra of other shards, so it warns
+    about a reference to one of them and makes up an id for it, unless the id was
+    registered beforehand in its :class:`~.SpectrumIdRegistry`, as with
+    ``writer.context["Spectrum"][id] = id``.
+
+    The shards are copied without parsing them as XML, locating the few tags which
+    change through their memory-mapped contents, so merging takes little more than
+    the time to copy the files.
+
+    Parameters
+    ----------
+    shard_paths : Sequence of str
+        The paths of the shards, in order
+    output : str or file
+        The path to write the merged document to, or a writable binary file,
+        which is closed when the document is complete. The file only needs to
+        support ``tell`` when `indexed` is set
+    indexed : bool, optional
+        Whether to write an offset index and checksum for the merged document,
+        as :class:`~.MzMLWriter` does with ``indexed=True``
+    chunk_size : int, optional
+        The number of bytes to copy at once
+
+    Returns
+    -------
+    int
+        The number of spectra in the merged document
+    """
+    shards = []
+    try:
+        for path in shard_paths:
+            shards.append(_Shard(path))
+        if not shards:
+            raise ValueError("At least one shard is required")
+        count = _count_unique(shards, "spectrum", _Shard.spectrum_ids)
+        chromatogram_count = _count_unique(shards, "chromatogram", _Shard.chromatogram_ids)
+
+        if isinstance(output, basestring):
+            output = open(output, 'wb')
+        mzml_writer = MzMLWriter(output, indexed=indexed, backend="bytes")
+        mzml_writer._begin()
+        if indexed:
+            mzml_writer.index_toplevel = element(mzml_writer.writer, IndexedMzML())
+            mzml_writer.index_toplevel.__enter__()
+        mzml_writer.writer.flush()
+
+        if indexed:
+            copier = _ShardCopier(
+                mzml_writer.outfile, mzml_writer.spectrum_offset_index,
+                mzml_writer.chromatogram_offset_index, chunk_size)
+        else:
+            copier = _ShardCopier(mzml_writer.outfile, None, None, chunk_size)
+        first = shards[0]
+        copier.copy(first.data, first.start, first.spectrum_list_tag.start())
+        mzml_writer.outfile.write(_list_start_tag(first.spectrum_list_tag.group(), count))
+        for shard in shards:
+            copier.copy_spectra(shard)
+        mzml_writer.outfile.write(_spectrum_list_end)
+
+        # The chromatogram list takes the first shard's place, or when it has none,
+        # follows the spectrum list as it would have
+        list_shard = first
+        if chromatogram_count and first.chromatogram_list_tag is None:
+            list_shard = next(
+                shard for shard in shards if shard.chromatograms_start < shard.chromatograms_end)
+        if list_shard.chromatogram_list_tag is None:
+            copier.copy(first.data, first.tail_start, first.end)
+        else:
+            if list_shard is first:
+                copier.copy(first.data, first.tail_start, first.chromatogram_list_tag.start())
+            mzml_writer.outfile.write(_list_start_tag(
+                list_shard.chromatogram_list_tag.group(), chromatogram_count))
+            for shard in shards:
+                copier.copy_chromatograms(shard)
+            mzml_writer.outfile.write(_chromatogram_list_end)
+            copier.copy(first.data, first.chromatogram_tail_start, first.end)
+        mzml_writer.spectrum_count = copier.spectrum_count
+        mzml_writer.chromatogram_count = copier.chromatogram_count
+
+        if indexed:
+            mzml_writer._write_index_list()
+            mzml_writer.index_toplevel.__exit__(None, None, None)
+        mzml_writer.writer.flush()
+        mzml_writer.xmlfile.__exit__(None, None, None)
+        mzml_writer.outfile.close()
+        return count
+    finally:
+        for shard in shards:
+            shard.close()
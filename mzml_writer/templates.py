@@ -0,0 +1,132 @@
+import re
+from collections import namedtuple
+
+
+SLOT_TEXT = 'text'
+SLOT_START_TAG_ATTRIBUTE = 'start tag attribute'
+SLOT_EMPTY_TAG_ATTRIBUTE = 'empty tag attribute'
+
+_slot_pattern = re.compile(b'\x1e(\\d+)\x1f')
+
+
+def slot(number):
+    """
+    Create the placeholder for slot `number`, to be passed through the usual
+    component API in place of a value when rendering a template's prototype.
+
+    Parameters
+    ----------
+    number : int
+
+    Returns
+    -------
+    str
+    """
+    return '\x1e%d\x1f' % number
+
+
+class Template(object):
+    """
+    A document fragment pre-rendered into static byte segments around
+    typed slots, to be written again and again with different slot values.
+
+    Templates are compiled from the output of a :class:`~.ByteXMLFile` into which
+    a prototype was written with :func:`slot` placeholders standing in for each
+    value. Each slot is escaped according to where its placeholder was found,
+    so filling a template produces the same bytes as writing the prototype's
+    components with those values would.
+
+    Attributes
+    ----------
+    segments : list of bytes
+        The static bytes before, between and after the slots
+    slots : list of tuple
+        The number and kind of each slot, in document order
+    """
+    def __init__(self, rendered):
+        self.segments = []
+        self.slots = []
+        last = 0
+        for match in _slot_pattern.finditer(rendered):
+            start, end = match.span()
+            self.segments.append(rendered[last:start])
+            self.slots.append((int(match.group(1)), self._slot_kind(rendered, start, end)))
+            last = end
+        self.segments.append(rendered[last:])
+
+    @staticmethod
+    def _slot_kind(rendered, start, end):
+        if rendered.rfind(b'<', 0, start) < rendered.rfind(b'>', 0, start):
+            return SLOT_TEXT
+        if rendered[rendered.find(b'>', end) - 1:][:1] == b'/':
+            return SLOT_EMPTY_TAG_ATTRIBUTE
+        return SLOT_START_TAG_ATTRIBUTE
+
+    def write(self, xml_file, values):
+        """
+        Fill the slots with `values` and write the result.
+
+        Parameters
+        ----------
+        xml_file : :class:`~.ByteXMLFile`
+            The writer the template was compiled for
+        values : Sequence
+            The value of each slot, by slot number. Attribute values are
+            converted with :class:`str`, text may be a string or an iterable
+            of strings, like a :class:`~.StreamingEncodedArray`, which is
+            written one string at a time.
+        """
+        parts = []
+        segments = self.segments
+        for i, (number, kind) in enumerate(self.slots):
+            parts.append(segments[i])
+            value = values[number]
+            if kind == SLOT_TEXT:
+                if isinstance(value, (bytes, type(u''))):
+                    parts.append(xml_file.text_bytes(value))
+                else:
+                    # Streamed text is written as it comes, rather than
+                    # collected, so that it never has to be held at once
+                    xml_file.write_bytes(b''.join(parts))
+                    parts = []
+                    for chunk in value:
+                        xml_file.write_bytes(xml_file.text_bytes(chunk))
+            else:
+                parts.append(xml_file.attribute_bytes(
+                    str(value), kind == SLOT_START_TAG_ATTRIBUTE))
+        parts.append(segments[-1])
+        xml_file.write_bytes(b''.join(parts))
+
+
+TemplateElement = namedtuple("TemplateElement", ["id"])
+
+
+class TemplatedComponent(object):
+    """
+    A component written by filling a :class:`Template`, standing in
+    for a :class:`~.ComponentBase` in the writer.
+
+    Attributes
+    ----------
+    template : :class:`Template`
+    values : list
+        The slot values
+    element : :class:`TemplateElement`
+        Carries the id of the written element, for the offset index
+    array_slots : list of tuple
+        The slot numbers of the encoded length and the text of each binary
+        data array, filled by :meth:`attach_arrays`
+    """
+    def __init__(self, template, values, id, array_slots):
+        self.template = template
+        self.values = values
+        self.element = TemplateElement(id)
+        self.array_slots = array_slots
+
+    def attach_arrays(self, encoded_arrays):
+        for (length_slot, text_slot), encoded in zip(self.array_slots, encoded_arrays):
+            self.values[length_slot] = len(encoded)
+            self.values[text_slot] = encoded
+
+    def write(self, xml_file):
+        self.template.write(xml_file, self.values)
@@ -0,0 +1,97 @@
+import threading
+from contextlib import contextmanager
+
+try:
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Queue
+
+from .deferred import DeferredElement, DeferredMzMLWriter
+
+
+class ThreadedMzMLWriter(DeferredMzMLWriter):
+    """
+    A front end to :class:`~.MzMLWriter` which does all of the encoding, serialization
+    and writing on a background thread, so that whatever produces the spectra only
+    pays for placing each call on a queue.
+
+    Calls to :meth:`write_spectrum` and the other writing methods are queued and
+    carried out in order on the writer thread. The queue holds at most :attr:`queue_size`
+    calls, beyond which callers block until the writer catches up. Arrays passed to
+    a queued call are not copied, so they must not be modified afterwards.
+
+    If a queued call fails, the remaining calls are discarded except for closing the
+    document, and the error is raised by the next call to a writing method, by
+    :meth:`flush`, or when leaving the ``with`` block.
+
+    Attributes
+    ----------
+    mzml_writer : :class:`~.MzMLWriter`
+        The writer the queued calls are carried out by. It must not be used directly
+        while the writer thread is running.
+    queue_size : int
+        The number of calls which may be waiting at once
+    """
+    def __init__(self, outfile, queue_size=64, **kwargs):
+        super(ThreadedMzMLWriter, self).__init__(outfile, **kwargs)
+        self.queue_size = queue_size
+        self._queue = Queue(queue_size)
+        self._thread = None
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            task = queue.get()
+            try:
+                if task is None:
+                    return
+                self._carry_out(*task)
+                if queue.empty() and self._error is None:
+                    self._flush_writer()
+            finally:
+                queue.task_done()
+
+    def _defer(self, func, args=(), kwargs=None, always=False):
+        # Blocks while the queue is full
+        if not always:
+            self._raise_error()
+        self._queue.put((func, args, kwargs, always))
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="ThreadedMzMLWriter")
+        self._thread.daemon = True
+        self._thread.start()
+        self._open_document()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._close_document(exc_type, exc_value, traceback)
+        self._queue.put(None)
+        self._thread.join()
+        if exc_type is None:
+            self._raise_error()
+
+    def flush(self):
+        """
+        Wait until every queued call has been carried out, and raise
+        the error from any which failed.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    @contextmanager
+    def element(self, element_name, **kwargs):
+        """
+        Queue writing the start tag of `element_name`, and its end
+        tag when the ``with`` block is left.
+
+        See Also
+        --------
+        :meth:`.XMLWriterMixin.element`
+        """
+        element = DeferredElement(self.mzml_writer, element_name, kwargs)
+        self._open_element(element)
+        try:
+            yield
+        finally:
+            self._close_element(element)
@@ -1,4 +1,7 @@
-from collections import Iterable, Mapping
+try:
+    from collections.abc import Iterable, Mapping
+except ImportError:  # pragma: no cover
+    from collections import Iterable, Mapping
 
 try:
     basestring = basestring
@@ -12,3 +15,23 @@ def ensure_iterable(obj):
     if not isinstance(obj, Iterable) or isinstance(obj, basestring) or isinstance(obj, Mapping):
         return [obj]
     return obj
+
+
+def with_metaclass(meta, *bases):
+    """
+    Create a base class with the metaclass `meta`, in a way both
+    Python 2 and Python 3 understand, as :func:`six.with_metaclass` does.
+
+    Parameters
+    ----------
+    meta : type
+    *bases : type
+
+    Returns
+    -------
+    type
+    """
+    class metaclass(type):
+        def __new__(cls, name, this_bases, attrs):
+            return meta(name, bases, attrs)
+    return type.__new__(metaclass, 'temporary_class', (), {})
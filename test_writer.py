@@ -1,3 +1,11 @@
+import hashlib
+import io
+import os
+import re
+import sys
+from array import array
+
+import pytest
 from mzml_writer import components, binary_encoding, writer
 from pyteomics import mzml
 import numpy as np
@@ -55,14 +63,755 @@ charge_array = [
 ]
 
 
-f = writer.MzMLWriter(open(path, 'wb'))
+@pytest.fixture(autouse=True)
+def _in_tmpdir(tmpdir, monkeypatch):
+    # Every document a test writes goes into a directory of its own, while
+    # vocabularies still come from the cache the tests started with
+    from mzml_writer import controlled_vocabulary
+    monkeypatch.setattr(controlled_vocabulary.obo_cache, "cache_path",
+                        os.path.abspath(controlled_vocabulary.obo_cache.cache_path))
+    monkeypatch.chdir(tmpdir)
+
+
+def test_write_spectrum():
+    f = writer.MzMLWriter(open(path, 'wb'))
+
+    with f:
+        f.controlled_vocabularies()
+        with f.element('run'):
+            f.write_spectrum(mz_array, intensity_array, charge_array, id='scanId=1', params=[
+                {"name": "ms level", "value": 1}], polarity='negative scan')
+
+    spec = next(mzml.read(path))
+    assert (all(np.abs(spec['m/z array'] - mz_array) < 1e-4))
+
+
+def test_indexed_writer():
+    indexed_path = "test_indexed_mzml.mzml"
+    f = writer.MzMLWriter(open(indexed_path, 'wb'), indexed=True)
+    with f:
+        f.controlled_vocabularies()
+        with f.element('run'):
+            with f.element('spectrumList', count=2):
+                f.write_spectrum(mz_array, intensity_array, charge_array, id='scanId=1', params=[
+                    {"name": "ms level", "value": 1}], polarity='negative scan')
+                f.write_spectrum(mz_array, intensity_array, charge_array, id='scanId=2', params=[
+                    {"name": "ms level", "value": 1}], polarity='negative scan')
+            with f.element('chromatogramList', count=1):
+                f.write_chromatogram([0.1, 0.2, 0.3], [10, 20, 30], id='TIC')
+
+    with open(indexed_path, 'rb') as fh:
+        content = fh.read()
+    for (scan_id, offset) in f.spectrum_offset_index:
+        assert content[offset:].startswith(b'<spectrum ')
+        assert ('id="%s"' % scan_id).encode('ascii') in content[offset:content.index(b'>', offset)]
+    for (chrom_id, offset) in f.chromatogram_offset_index:
+        assert content[offset:].startswith(b'<chromatogram ')
+    index_list_offset = int(content.split(b"<indexListOffset>")[1].split(b"<")[0])
+    assert content[index_list_offset:].startswith(b"<indexList ")
+    checksum_end = content.index(b"<fileChecksum>") + len(b"<fileChecksum>")
+    checksum = content[checksum_end:content.index(b"</fileChecksum>")]
+    assert checksum == hashlib.sha1(content[:checksum_end]).hexdigest().encode('ascii')
+    assert len(list(mzml.read(indexed_path))) == 2
+    assert b'<indexList count="2"><index name="spectrum">' in content
+    assert b'<index name="chromatogram"><offset idRef="TIC">' in content
+
+    content = _write_spectra("test_indexed_mzml.mzml", indexed=True)
+    assert b'<indexList count="1"><index name="spectrum">' in content
+    assert b'<index name="chromatogram"' not in content
+
+
+def _strip_creation_date(content):
+    return re.sub(br'creationDate="[^"]+"', b'', content)
+
+
+def _write_spectra(path, compression=binary_encoding.COMPRESSION_ZLIB, **kwargs):
+    f = writer.MzMLWriter(open(path, 'wb'), **kwargs)
+    with f:
+        f.controlled_vocabularies()
+        with f.element('run'):
+            for i in range(10):
+                f.write_spectrum(
+                    np.array(mz_array) + i, intensity_array, charge_array, id='scanId=%d' % i,
+                    params=[{"name": "ms level", "value": 1}], polarity='negative scan',
+                    compression=compression)
+    with open(path, 'rb') as fh:
+        return _strip_creation_date(fh.read())
+
+
+def test_threaded_encoding_preserves_output():
+    serial = _write_spectra("test_serial_mzml.mzml")
+    threaded = _write_spectra("test_threaded_mzml.mzml", encoding_threads=2, max_pending=3)
+    assert serial == threaded
+
+
+def _write_reused_buffer(path, **kwargs):
+    buffer = np.zeros(5)
+    f = writer.MzMLWriter(open(path, 'wb'), **kwargs)
+    with f:
+        f.controlled_vocabularies()
+        with f.element('run'):
+            for i in range(5):
+                buffer[:] = i
+                f.write_spectrum(buffer, buffer, id='scan=%d' % i)
+    return [spectrum['m/z array'][0] for spectrum in mzml.read(path)]
+
+
+def test_threaded_encoding_copies_arrays():
+    assert _write_reused_buffer("test_threaded_mzml.mzml", encoding_threads=2) == [0, 1, 2, 3, 4]
+
+
+def test_failed_encoding_still_closes_document():
+    def broken(numeric, **kwargs):
+        raise ZeroDivisionError()
+
+    for error in (None, KeyError):
+        outfile = open("test_threaded_mzml.mzml", 'wb')
+        f = writer.MzMLWriter(outfile, encoding_threads=2, indexed=True)
+        # The error raised is the one from the block, when there is one
+        with pytest.raises(error or ZeroDivisionError):
+            with f:
+                f.controlled_vocabularies()
+                with f.element('run'):
+                    f.write_spectrum(mz_array, intensity_array, id='scan=1')
+                    f._encode_array = broken
+                    f.write_spectrum(mz_array, intensity_array, id='scan=2')
+                    if error is not None:
+                        raise error()
+        assert outfile.closed
+        with open("test_threaded_mzml.mzml", 'rb') as fh:
+            assert fh.read().rstrip().endswith(b'</indexedmzML>')
+
+
+class _WriteRecorder(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.largest_write = 0
+
+    def write(self, data):
+        self.largest_write = max(self.largest_write, len(data))
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+def test_streamed_arrays_are_written_in_chunks():
+    mz = np.linspace(100, 2000, 2 ** 20)
+    for kwargs in ({}, {"backend": "bytes"}, {"backend": "bytes", "use_templates": False}):
+        outfile = _WriteRecorder(open("test_streamed_mzml.mzml", 'wb'))
+        f = writer.MzMLWriter(outfile, streaming_threshold=2 ** 16, **kwargs)
+        with f:
+            f.controlled_vocabularies()
+            with f.element('run'):
+                f.write_spectrum(mz, mz, id='scan=1', compression=binary_encoding.COMPRESSION_NONE)
+        # Each array is over 5 MB of base64, streamed in chunks of about 1 MB
+        assert outfile.largest_write < 2 ** 21
+        spectrum = next(mzml.read("test_streamed_mzml.mzml"))
+        assert np.allclose(spectrum['m/z array'], mz)
+
+
+def test_numpress_round_trip():
+    mz = np.array(mz_array)
+    for compression in (binary_encoding.COMPRESSION_NUMPRESS_LINEAR,
+                        binary_encoding.COMPRESSION_NUMPRESS_LINEAR_ZLIB):
+        encoded = binary_encoding.encode_array(mz, compression=compression)
+        decoded = binary_encoding.decode_array(encoded, compression=compression, dtype=np.float64)
+        assert np.allclose(decoded, mz, rtol=1e-6)
+        # Decoded as doubles unless another type is asked for
+        default, = binary_encoding.decode_arrays([encoded], compression=compression)
+        assert default.dtype == np.float64 and np.array_equal(default, decoded)
+    for compression in (binary_encoding.COMPRESSION_NUMPRESS_SLOF,
+                        binary_encoding.COMPRESSION_NUMPRESS_SLOF_ZLIB):
+        encoded = binary_encoding.encode_array(intensity_array, compression=compression)
+        decoded = binary_encoding.decode_array(encoded, compression=compression, dtype=np.float64)
+        assert np.allclose(decoded, intensity_array, rtol=1e-3)
+    for compression in (binary_encoding.COMPRESSION_NUMPRESS_PIC,
+                        binary_encoding.COMPRESSION_NUMPRESS_PIC_ZLIB):
+        counts = np.round(intensity_array)
+        encoded = binary_encoding.encode_array(counts, compression=compression)
+        decoded = binary_encoding.decode_array(encoded, compression=compression, dtype=np.float64)
+        assert np.all(decoded == counts)
+    # The reference implementation's encoding of these values
+    assert binary_encoding.encode_numpress_pic(np.array([0., 1, 17, 300, 5])) == b'\x87\x16\x11\x5c\x21\x75'
+
+    # Numpress decodes to doubles, whatever encoding was asked for
+    content = _write_spectra(
+        "test_numpress_mzml.mzml", compression=binary_encoding.COMPRESSION_NUMPRESS_LINEAR)
+    assert b'name="64-bit float"' in content
+    assert b'name="32-bit float"' not in content
+
+
+def test_streaming_encoded_array():
+    array = np.linspace(100, 2000, 100003)
+    for compression in (binary_encoding.COMPRESSION_NONE, binary_encoding.COMPRESSION_ZLIB):
+        streamed = binary_encoding.StreamingEncodedArray(
+            array, compression=compression, dtype=np.float64, chunk_size=3 * 1024, spool_size=1024)
+        text = b''.join(streamed)
+        assert len(text) == streamed.encoded_length
+        decoded = binary_encoding.decode_array(text, compression=compression, dtype=np.float64)
+        assert np.all(decoded == array)
+    serial = _write_spectra("test_serial_mzml.mzml")
+    streamed = _write_spectra("test_streamed_mzml.mzml", streaming_threshold=10)
+    assert streamed == serial
+    decoded = [spec['m/z array'] for spec in mzml.read("test_streamed_mzml.mzml")]
+    assert len(decoded) == 10
+    assert np.allclose(decoded[-1], np.array(mz_array) + 9)
+
+
+def test_integer_encoding():
+    assert binary_encoding.resolve_dtype(None, charge_array) == np.int32
+    assert binary_encoding.resolve_dtype(None, np.array([2 ** 40])) == np.int64
+    assert binary_encoding.resolve_dtype('int64') == np.int64
+    assert binary_encoding.resolve_dtype(np.float64) == np.float64
+    assert binary_encoding.resolve_dtype(32) == np.float32
+    content = _write_spectra("test_integer_mzml.mzml")
+    assert b'name="32-bit integer"' in content
+    tree = etree.parse("test_integer_mzml.mzml")
+    for data_array in tree.iter("{*}binaryDataArray"):
+        names = [param.get("name") for param in data_array.iter("{*}userParam", "{*}cvParam")]
+        if 'charge array' in names:
+            assert '32-bit integer' in names
+            decoded = binary_encoding.decode_array(
+                data_array.find("{*}binary").text, compression='zlib', dtype=np.int32)
+            assert np.all(decoded == charge_array)
+
+
+def test_codec_policy():
+    small = np.array(mz_array[:3])
+    large = np.linspace(100, 2000, 5000)
+    threshold = binary_encoding.MinimumSizeCodecPolicy(min_points=10)
+    assert threshold.select(small) == binary_encoding.COMPRESSION_NONE
+    assert threshold.select(large) == binary_encoding.COMPRESSION_ZLIB
+    smallest = binary_encoding.SmallestCodecPolicy()
+    assert smallest.select(small) == binary_encoding.COMPRESSION_NONE
+    assert smallest.select(np.zeros(1000)) == binary_encoding.COMPRESSION_ZLIB
+    # pic cannot encode negative values, so it is passed over
+    with_pic = binary_encoding.SmallestCodecPolicy(
+        [binary_encoding.COMPRESSION_NUMPRESS_PIC, binary_encoding.COMPRESSION_ZLIB])
+    assert with_pic.select(charge_array, np.int32) == binary_encoding.COMPRESSION_ZLIB
+    per_array = binary_encoding.ArrayTypeCodecPolicy(
+        {writer.CHARGE_ARRAY: binary_encoding.COMPRESSION_NONE}, default=threshold)
+    content = _write_spectra("test_policy_mzml.mzml", compression=per_array)
+    assert content.count(b'name="no compression"') == 10
+    assert content.count(b'name="zlib compression"') == 20
+
+
+def test_encoded_array_cache():
+    cache = binary_encoding.EncodedArrayCache()
+    serial = _write_spectra("test_serial_mzml.mzml")
+    cached = _write_spectra("test_cached_mzml.mzml", encoding_cache=cache)
+    assert serial == cached
+    # intensity and charge arrays repeat across all 10 spectra, m/z never does
+    assert cache.hits == 18
+    assert cache.misses == 12
+    small = binary_encoding.EncodedArrayCache(max_size=100)
+    small.encode(np.arange(10), binary_encoding.COMPRESSION_NONE)
+    small.encode(np.arange(11), binary_encoding.COMPRESSION_NONE)
+    assert len(small) == 1 and small.size <= 100
+
+
+def test_decode_arrays():
+    arrays = [np.array(mz_array) + i for i in range(8)]
+    payloads = [binary_encoding.encode_array(a, binary_encoding.COMPRESSION_ZLIB, np.float64)
+                for a in arrays]
+    decoded = binary_encoding.decode_arrays(
+        payloads, compression=binary_encoding.COMPRESSION_ZLIB, dtype=np.float64, max_workers=4)
+    assert all(np.all(d == a) for d, a in zip(decoded, arrays))
+    mixed = binary_encoding.decode_arrays([
+        (binary_encoding.encode_array(charge_array, binary_encoding.COMPRESSION_NONE, np.int32),
+         binary_encoding.COMPRESSION_NONE, np.int32),
+        (binary_encoding.encode_array(arrays[0], binary_encoding.COMPRESSION_NUMPRESS_LINEAR),
+         binary_encoding.COMPRESSION_NUMPRESS_LINEAR, np.float64),
+    ])
+    assert np.all(mixed[0] == charge_array)
+    assert np.allclose(mixed[1], arrays[0])
+
+
+def test_truncate_mantissa():
+    values = np.array(intensity_array + [0.0, np.inf, np.nan], dtype=np.float32)
+    rounded, error = binary_encoding.truncate_mantissa(values, 8)
+    assert rounded.dtype == np.float32
+    assert 0 < error <= 2 ** -9
+    finite = np.isfinite(values)
+    assert np.allclose(rounded[finite], values[finite], rtol=2 ** -9, atol=0)
+    assert np.isinf(rounded[-2]) and np.isnan(rounded[-1])
+    assert np.all(rounded[:-1].view(np.uint32) & 0x7FFF == 0)
+    rounded, error = binary_encoding.truncate_mantissa(values, 23)
+    assert error == 0.0
+
+    out = open("test_precision_mzml.mzml", 'wb')
+    f = writer.MzMLWriter(out)
+    with f:
+        f.controlled_vocabularies()
+        with f.element('run'):
+            f.write_spectrum(mz_array, intensity_array, id='scan=1', precision=10)
+    assert 0 < f.precision_errors[writer.INTENSITY_ARRAY] <= 2 ** -11
+    assert writer.MZ_ARRAY not in f.precision_errors
+    spectrum = next(mzml.read("test_precision_mzml.mzml"))
+    assert np.allclose(spectrum['intensity array'], intensity_array, rtol=2 ** -11, atol=0)
+    assert np.allclose(spectrum['m/z array'], mz_array)
+
+
+def test_write_spectra_matches_write_spectrum():
+    n = 10
+    mz = np.concatenate([np.array(mz_array) + i for i in range(n)])
+    intensity = np.tile(intensity_array, n)
+    charge = np.tile(charge_array, n)
+    offsets = np.arange(n + 1) * len(mz_array)
+    expected = _write_spectra("test_serial_mzml.mzml")
+    for kwargs in ({}, {"encoding_threads": 2, "max_pending": 1}, {"backend": "bytes"},
+                   {"backend": "bytes", "use_templates": False}):
+        f = writer.MzMLWriter(open("test_batch_mzml.mzml", 'wb'), **kwargs)
+        with f:
+            f.controlled_vocabularies()
+            with f.element('run'):
+                f.write_spectra(
+                    mz, intensity, offsets, charge, ids=['scanId=%d' % i for i in range(n)],
+                    ms_levels=1, polarities='negative scan')
+        with open("test_batch_mzml.mzml", 'rb') as fh:
+            assert _strip_creation_date(fh.read()) == expected
+
+    contents = []
+    for backend in ("lxml", "bytes"):
+        f = writer.MzMLWriter(open("test_batch_mzml.mzml", 'wb'), backend=backend)
+        with f:
+            f.controlled_vocabularies()
+            with f.element('run'):
+                f.write_spectra(
+                    mz[:60], intensity[:60], [0, 20, 60], ids=['scan=1', 'scan=2'],
+                    scan_start_times=[1.5, 1.6], ms_levels=[1, 2], precursor_mzs=[np.nan, 500.25],
+                    precursor_intensities=[np.nan, 10.0], precursor_charges=[0, 2],
+                    precursor_scan_ids=[None, 'scan=1'])
+        with open("test_batch_mzml.mzml", 'rb') as fh:
+            contents.append(_strip_creation_date(fh.read()))
+    assert contents[0] == contents[1]
+    spectra = list(mzml.read("test_batch_mzml.mzml"))
+    assert [s['defaultArrayLength'] for s in spectra] == [20, 40]
+    assert 'precursorList' not in spectra[0]
+    assert spectra[1]['precursorList']['precursor'][0]['spectrumRef'] == 'scan=1'
+    assert np.allclose(spectra[1]['m/z array'], mz[20:60])
+
+
+def test_byte_backend_matches_lxml():
+    for kwargs in ({}, {"indexed": True}):
+        # The checksum covers the creation date, so it differs between runs
+        expected = re.sub(br'<fileChecksum>\w+', b'', _write_spectra("test_serial_mzml.mzml", **kwargs))
+        content = _write_spectra("test_bytes_mzml.mzml", backend="bytes", **kwargs)
+        assert re.sub(br'<fileChecksum>\w+', b'', content) == expected
+    for backend in ("lxml", "bytes"):
+        f = writer.MzMLWriter(open("test_%s_mzml.mzml" % backend, 'wb'), backend=backend)
+        with f:
+            f.controlled_vocabularies()
+            with f.element('run', id='run "1"\t<&>'):
+                f.write_spectrum(
+                    mz_array, intensity_array, id='scan=\n1', polarity='negative scan',
+                    params=[{"name": "comment", "value": '& <\r"\'>\t\n'}])
+    with open("test_lxml_mzml.mzml", 'rb') as fh:
+        expected = _strip_creation_date(fh.read())
+    with open("test_bytes_mzml.mzml", 'rb') as fh:
+        assert _strip_creation_date(fh.read()) == expected
+
+    text = u'\xe9\u4e2d & <\r"\'>\t\n'
+    for encoding in (None, 'utf-8'):
+        outputs = []
+        for xmlfile in (etree.xmlfile, components.ByteXMLFile):
+            buffer = io.BytesIO()
+            with xmlfile(buffer, encoding=encoding) as xml_file:
+                with xml_file.element('a', b=text):
+                    xml_file.write(text)
+                    xml_file.write(etree.Element('c', d=text))
+                    if isinstance(xml_file, components.ByteXMLFile):
+                        xml_file.write_empty('e', {'f': text})
+                    else:
+                        xml_file.write(etree.Element('e', f=text))
+            outputs.append(buffer.getvalue())
+        assert outputs[0] == outputs[1]
+
+
+def _write_varied_spectra(path, **kwargs):
+    f = writer.MzMLWriter(open(path, 'wb'), **kwargs)
+    with f:
+        f.controlled_vocabularies()
+        with f.element('run'):
+            for i in range(6):
+                precursor = None
+                if i % 2:
+                    precursor = {"mz": 500.25 + i, "intensity": None if i == 3 else 1e3 * i,
+                                 "charge": i, "scan_id": 'scan=%d' % (i - 1)}
+                f.write_spectrum(
+                    np.array(mz_array) + i, intensity_array, id='scan=%d' % i,
+                    params=[{"name": "ms level", "value": 1 + i % 2},
+                            {"name": "comment", "value": None if i == 4 else 'a&b %d' % i},
+                            "MSn spectrum"],
+                    polarity=i % 3 - 1, scan_start_time=i * 0.5, precursor_information=precursor,
+                    encoding={writer.INTENSITY_ARRAY: 64 if i == 5 else 32})
+            f.write_spectrum(mz_array, intensity_array, params=["MSn spectrum"])
+    with open(path, 'rb') as fh:
+        return re.sub(br'<fileChecksum>\w+', b'', _strip_creation_date(fh.read()))
+
+
+def test_spectrum_templates():
+    expected = _write_varied_spectra("test_serial_mzml.mzml", indexed=True)
+    for kwargs in ({}, {"encoding_threads": 2}, {"max_templates": 2}):
+        content = _write_varied_spectra(
+            "test_templated_mzml.mzml", backend="bytes", indexed=True, **kwargs)
+        assert content == expected
+    assert writer.MzMLWriter(io.BytesIO(), backend="bytes").use_templates
+    with pytest.raises(ValueError):
+        writer.MzMLWriter(io.BytesIO(), use_templates=True)
+
+
+def test_rendering_processes():
+    expected = _write_varied_spectra("test_serial_mzml.mzml", indexed=True)
+    for kwargs in ({"render_batch_size": 3}, {"render_batch_size": 1, "max_pending": 1}):
+        content = _write_varied_spectra(
+            "test_rendered_mzml.mzml", backend="bytes", indexed=True, rendering_processes=2,
+            **kwargs)
+        assert content == expected
+    with pytest.raises(ValueError):
+        writer.MzMLWriter(io.BytesIO(), rendering_processes=2)
+
+
+def test_rendering_processes_options():
+    from concurrent.futures import ThreadPoolExecutor
+    assert _write_reused_buffer(
+        "test_rendered_mzml.mzml", backend="bytes", rendering_processes=2,
+        render_batch_size=5) == [0, 1, 2, 3, 4]
+
+    # Rendered on a thread to look at the worker's writer afterwards
+    for options in ({"streaming_threshold": 10}, {"encoding_cache": 2 ** 16}):
+        expected = _write_varied_spectra("test_serial_mzml.mzml", backend="bytes", **options)
+        writer._renderers.clear()
+        with ThreadPoolExecutor(1) as executor:
+            content = _write_varied_spectra(
+                "test_rendered_mzml.mzml", backend="bytes", rendering_processes=executor,
+                **options)
+        assert content == expected
+        renderer, = writer._renderers.values()
+        worker = renderer.mzml_writer
+        if "streaming_threshold" in options:
+            assert worker.streaming_threshold == 10 and worker.encoding_cache is None
+        else:
+            assert worker.encoding_cache.max_size == 2 ** 16 and worker.encoding_cache.misses > 0
+
+
+class _DictVocabulary(dict):
+    def __init__(self, id, terms):
+        dict.__init__(self, terms)
+        self.id = id
+
+
+def test_param_resolution_cache():
+    units = _DictVocabulary("UO", {"dalton": {"name": "dalton", "id": "UO:0000221"}})
+    resolver = components.VocabularyResolver([units])
+    for _ in range(3):
+        param = resolver.param("dalton", 5)
+        assert (param.ref, param.accession, param.value) == ("UO", "UO:0000221", 5)
+        assert isinstance(resolver.param({"name": "not a term"}), components.UserParam)
+    assert (resolver.resolution_hits, resolver.resolution_misses) == (4, 2)
+
+    resolver.vocabularies.append(_DictVocabulary("XX", {"not a term": {"name": "a term", "id": "XX:1"}}))
+    param = resolver.param({"name": "not a term"})
+    assert (param.ref, param.name) == ("XX", "a term")
+    assert (resolver.resolution_hits, resolver.resolution_misses) == (0, 1)
+    resolver.vocabularies = [units]
+    assert isinstance(resolver.param("not a term"), components.UserParam)
+
+    resolver.max_resolved_names = 4
+    for i in range(10):
+        resolver.param("user term %d" % i, i)
+    assert len(resolver._resolution_cache) <= 4
+    assert resolver.param("dalton", 1).accession == "UO:0000221"
+
+
+def test_constant_params_are_shared():
+    resolver = components.VocabularyResolver([])
+    param = resolver.param("centroid spectrum")
+    assert isinstance(param, components.ConstantUserParam)
+    assert resolver.param({"name": "centroid spectrum"}) is param
+    assert resolver.param("centroid spectrum", 1) is not param
+    with pytest.raises(AttributeError):
+        param.value = 1
+    outputs = []
+    for xmlfile in (etree.xmlfile, components.ByteXMLFile):
+        buffer = io.BytesIO()
+        with xmlfile(buffer) as xml_file:
+            with xml_file.element('a'):
+                param(xml_file)
+                param(xml_file)
+        outputs.append(buffer.getvalue())
+    assert outputs[0] == outputs[1] == (
+        b'<a>' + b'<userParam name="centroid spectrum" value=""/>' * 2 + b'</a>')
+
+
+_small_obo = b"""format-version: 1.2
+data-version: 1.0.0
+
+[Term]
+id: MS:1
+name: root
+
+[Term]
+id: MS:2
+name: Child Term
+is_a: MS:1 ! root
+relationship: part_of MS:1
+relationship: has_units UO:0000221 ! dalton
+"""
+
+
+def test_vocabulary_snapshot(tmpdir):
+    from mzml_writer import controlled_vocabulary
+    tmpdir.join("small.obo").write_binary(_small_obo)
+    cache = controlled_vocabulary.OBOCache(str(tmpdir))
+    parsed = cache.load_vocabulary("http://example.org/small.obo")
+    snapshot = "small.obo" + controlled_vocabulary._snapshot_suffix
+    assert sorted(path.basename for path in tmpdir.listdir()) == ["small.obo", snapshot]
+    loaded = cache.load_vocabulary("http://example.org/small.obo")
+    for cv in (parsed, loaded):
+        term = cv["child term"]
+        assert term.parent() is cv["MS:1"]
+        assert cv["root"].children == [term]
+        assert (term.part_of.accession, term.part_of.comment) == ("MS:1", None)
+        assert (term.has_units.accession, term.has_units.comment) == ("UO:0000221", "dalton")
+
+    tmpdir.join("small.obo").write_binary(_small_obo.replace(b"name: root", b"name: base"))
+    assert "base" in cache.load_vocabulary("http://example.org/small.obo").names()
+
+
+def test_lazy_vocabulary(tmpdir):
+    from mzml_writer import controlled_vocabulary
+    tmpdir.join("small.obo").write_binary(_small_obo)
+    cache = controlled_vocabulary.OBOCache(str(tmpdir), lazy=True)
+    cv = cache.load_vocabulary("http://example.org/small.obo")
+    assert isinstance(cv, controlled_vocabulary.LazyControlledVocabulary)
+    assert tmpdir.listdir() == [tmpdir.join("small.obo")]
+    assert sorted(cv.keys()) == ["MS:1", "MS:2"] and cv.terms == {}
+    term = cv["child term"]
+    assert sorted(cv.terms) == ["MS:2"]
+    assert term.parent() is cv["root"]
+    assert cv["root"].children == [term]
+    assert term.has_units.accession == "UO:0000221"
+    assert not hasattr(cv, "_content")
+    cv.close()
+
+
+@pytest.mark.parametrize("stream", [io.BytesIO, lambda content: io.StringIO(content.decode('utf-8'))])
+def test_lazy_vocabulary_from_stream(stream):
+    from mzml_writer import controlled_vocabulary
+    cv = controlled_vocabulary.LazyControlledVocabulary.from_obo(stream(_small_obo))
+    assert cv._spans["MS:2"] == (_small_obo.index(b"id: MS:2"), len(_small_obo))
+    root = cv["ROOT"]
+    assert root["id"] == "MS:1" and cv.terms == {"MS:1": root}
+    assert cv["MS:2"].parent() is root and root.children == [cv["MS:2"]]
+    cv.close()
+
+
+def test_is_a(tmpdir):
+    from mzml_writer import controlled_vocabulary
+    # A term defined before its parent
+    obo = _small_obo.replace(b"[Term]", b"[Term]\nid: MS:3\nname: grandchild\nis_a: MS:2\n\n[Term]", 1)
+    tmpdir.join("small.obo").write_binary(obo)
+    # Parsed, then loaded from the snapshot, then indexed lazily
+    for lazy in (False, False, True):
+        cv = controlled_vocabulary.OBOCache(str(tmpdir), lazy=lazy).load_vocabulary(
+            "http://example.org/small.obo")
+        assert cv.ancestors("grandchild") == frozenset(["MS:1", "MS:2"])
+        assert cv.is_a("MS:3", "root") and cv.is_a("root", "root")
+        assert not cv.is_a("root", "MS:3")
+
+
+def test_is_a_cycle(tmpdir):
+    from mzml_writer import controlled_vocabulary
+    obo = _small_obo.replace(b"name: root\n", b"name: root\nis_a: MS:2 ! child term\n")
+    tmpdir.join("small.obo").write_binary(obo)
+    for lazy in (False, False, True):
+        cv = controlled_vocabulary.OBOCache(str(tmpdir), lazy=lazy).load_vocabulary(
+            "http://example.org/small.obo")
+        assert cv.ancestors("root") == frozenset(["MS:2"])
+        assert cv.ancestors("MS:2") == frozenset(["MS:1"])
+        assert cv.is_a("root", "MS:2") and cv.is_a("MS:2", "root")
+
+
+def test_spectrum_id_registry():
+    registry = components.DocumentContext()["Spectrum"]
+    assert isinstance(registry, components.SpectrumIdRegistry)
+    ids = ['scan=%d' % i for i in (3, 1, 2, 5, 10, 0)] + ['scan=007', 'index', 'scan=5']
+    for id in ids:
+        registry[id] = id
+    registry[4] = 'SPECTRUM_4'
+    assert registry._runs['scan='] == (array('l', [0, 5, 10]), array('l', [3, 5, 10]))
+    assert all(registry[id] == id for id in ids)
+    assert registry[4] == 'SPECTRUM_4'
+    assert 'scan=4' not in registry and 'scan=07' not in registry
+    assert len(registry) == 9
+    assert sorted(registry, key=str) == sorted(set(ids) | set([4]), key=str)
+
+    # Overriding ids within runs splits or shrinks them
+    for id in ('scan=1', 'scan=0', 'scan=5', 'scan=1'):
+        registry[id] = 'other'
+    assert registry._runs['scan='] == (array('l', [2, 10]), array('l', [3, 10]))
+    assert registry['scan=1'] == registry['scan=5'] == 'other' and registry['scan=2'] == 'scan=2'
+    assert len(registry) == 9 and len(list(registry)) == 9
+    assert sorted(registry, key=str) == sorted(set(ids) | set([4]), key=str)
+
+
+def test_dispatcher_caches_constructors():
+    dispatcher = components.ComponentDispatcher()
+    assert dispatcher.Spectrum is dispatcher.Spectrum
+    assert dispatcher.Spectrum.keywords["context"] is dispatcher.context
+
+    class LateComponent(components.ComponentBase):
+        def __init__(self, context=components.NullMap):
+            self.context = context
+
+    assert dispatcher.LateComponent().context is dispatcher.context
+
+
+def test_documents_number_ids_independently():
+    from concurrent.futures import ThreadPoolExecutor
+
+    def write(i):
+        path = "test_thread_%d_mzml.mzml" % i
+        f = writer.MzMLWriter(open(path, 'wb'))
+        with f:
+            with f.element('run'):
+                for _ in range(50):
+                    f.write_spectrum(mz_array, intensity_array)
+        with open(path, 'rb') as fh:
+            return _strip_creation_date(fh.read())
+
+    with ThreadPoolExecutor(4) as executor:
+        outputs = list(executor.map(write, range(8)))
+    assert all(output == outputs[0] for output in outputs)
+    assert b'id="SPECTRUM_1"' in outputs[0] and b'id="SPECTRUM_50"' in outputs[0]
+
+
+def test_threaded_writer():
+    from mzml_writer.threaded import ThreadedMzMLWriter
+    expected = re.sub(br'<fileChecksum>\w+', b'', _write_spectra("test_serial_mzml.mzml", indexed=True))
+    f = ThreadedMzMLWriter(open("test_queued_mzml.mzml", 'wb'), queue_size=2, indexed=True)
+    with f:
+        f.controlled_vocabularies()
+        with f.element('run'):
+            for i in range(10):
+                f.write_spectrum(
+                    np.array(mz_array) + i, intensity_array, charge_array, id='scanId=%d' % i,
+                    params=[{"name": "ms level", "value": 1}], polarity='negative scan')
+            f.flush()
+    with open("test_queued_mzml.mzml", 'rb') as fh:
+        assert re.sub(br'<fileChecksum>\w+', b'', _strip_creation_date(fh.read())) == expected
+
+    f = ThreadedMzMLWriter(open("test_queued_mzml.mzml", 'wb'))
+    with pytest.raises(TypeError):
+        with f:
+            with f.element('run'):
+                f.write_spectrum(None, None, id='broken')
+                f.write_spectrum(mz_array, intensity_array, id='skipped')
+    spectra = list(mzml.read("test_queued_mzml.mzml"))
+    assert spectra == []
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="requires async/await")
+def test_async_writer():
+    import asyncio
+    from mzml_writer.asynchronous import AsyncMzMLWriter
+    expected = re.sub(br'<fileChecksum>\w+', b'', _write_spectra("test_serial_mzml.mzml", indexed=True))
+    loop = asyncio.new_event_loop()
+    run = loop.run_until_complete
+    f = AsyncMzMLWriter(open("test_async_mzml.mzml", 'wb'), max_in_flight=2, indexed=True)
+    run(f.__aenter__())
+    run(f.controlled_vocabularies())
+    run_element = f.element('run')
+    run(run_element.__aenter__())
+    # Scheduled concurrently, but written in the order they were called
+    run(asyncio.gather(*[
+        loop.create_task(f.write_spectrum(
+            np.array(mz_array) + i, intensity_array, charge_array, id='scanId=%d' % i,
+            params=[{"name": "ms level", "value": 1}], polarity='negative scan'))
+        for i in range(10)]))
+    run(f.flush())
+    run(run_element.__aexit__(None, None, None))
+    run(f.__aexit__(None, None, None))
+    with open("test_async_mzml.mzml", 'rb') as fh:
+        assert re.sub(br'<fileChecksum>\w+', b'', _strip_creation_date(fh.read())) == expected
+
+    f = AsyncMzMLWriter(open("test_async_mzml.mzml", 'wb'))
+    run(f.__aenter__())
+    run(f.write_spectrum(None, None, id='broken'))
+    with pytest.raises(TypeError):
+        run(f.write_spectrum(mz_array, intensity_array, id='skipped'))
+        run(f.flush())
+    run(f.__aexit__(TypeError, None, None))
+    loop.close()
+    assert list(mzml.read("test_async_mzml.mzml")) == []
+
+
+def _write_shard(path, start, stop, chromatograms=(), **kwargs):
+    f = writer.MzMLWriter(open(path, 'wb'), **kwargs)
+    with f:
+        f.controlled_vocabularies()
+        with f.element('run'):
+            with f.element('spectrumList', count=stop - start):
+                for i in range(start, stop):
+                    f.write_spectrum(
+                        np.array(mz_array) + i, intensity_array, id='scan="%d"' % i,
+                        params=[{"name": "ms level", "value": 1 + i % 2}])
+            if chromatograms:
+                with f.element('chromatogramList', count=len(chromatograms)):
+                    for id in chromatograms:
+                        f.write_chromatogram(mz_array, intensity_array, id=id)
+    with open(path, 'rb') as fh:
+        return _strip_creation_date(fh.read())
+
+
+def test_merge_shards():
+    from mzml_writer.merge import merge_shards
+    bounds = [(0, 4), (4, 4), (4, 9), (9, 10)]
+    # The first shard has no chromatograms for the list to take the place of
+    chromatograms = [(), ('tic 1',), ('tic 2', 'bpc 2'), ()]
+    for indexed in (False, True):
+        expected = re.sub(br'<fileChecksum>\w+', b'', _write_shard(
+            "test_serial_mzml.mzml", 0, 10, sum(chromatograms, ()), indexed=indexed))
+        paths = []
+        for i, (start, stop) in enumerate(bounds):
+            paths.append("test_shard_%d_mzml.mzml" % i)
+            _write_shard(paths[-1], start, stop, chromatograms[i], indexed=not indexed)
+        assert merge_shards(paths, "test_merged_mzml.mzml", indexed=indexed) == 10
+        with open("test_merged_mzml.mzml", 'rb') as fh:
+            content = _strip_creation_date(fh.read())
+        assert re.sub(br'<fileChecksum>\w+', b'', content) == expected
+    with open("test_merged_mzml.mzml", 'rb') as fh:
+        content = fh.read()
+    end = content.index(b'<fileChecksum>') + len(b'<fileChecksum>')
+    assert content[end:end + 40] == hashlib.sha1(content[:end]).hexdigest().encode('ascii')
+    reader = mzml.PreIndexedMzML("test_merged_mzml.mzml")
+    assert reader.get_by_id('scan="7"')['index'] == 7
+    assert reader.get_by_id('bpc 2')['index'] == 2
+
+    # The first shard's chromatogram list is extended
+    _write_shard(paths[0], 0, 4, ('tic 0',))
+    expected = _write_shard(
+        "test_serial_mzml.mzml", 0, 10, ('tic 0',) + sum(chromatograms, ()))
+    merge_shards(paths, "test_merged_mzml.mzml", indexed=False)
+    with open("test_merged_mzml.mzml", 'rb') as fh:
+        assert _strip_creation_date(fh.read()) == expected
 
-with f:
-    f.controlled_vocabularies()
-    with f.element('run'):
-        f.write_spectrum(mz_array, intensity_array, charge_array, id='scanId=1', params=[
-            {"name": "ms level", "value": 1}], polarity='negative scan')
+    # Without an index, the output need not be able to tell its position
+    merge_shards(paths, _WriteRecorder(open("test_merged_mzml.mzml", 'wb')), indexed=False)
+    with open("test_merged_mzml.mzml", 'rb') as fh:
+        assert _strip_creation_date(fh.read()) == expected
 
 
-spec = next(mzml.read(path))
-assert (all(np.abs(spec['m/z array'] - mz_array) < 1e-4))
+def test_merge_shards_rejects_duplicate_ids():
+    from mzml_writer.merge import merge_shards
+    _write_shard("test_shard_0_mzml.mzml", 0, 4, ('tic',))
+    for start, chromatograms in ((3, ()), (4, ('tic',))):
+        _write_shard("test_shard_1_mzml.mzml", start, 6, chromatograms)
+        with pytest.raises(ValueError):
+            merge_shards(["test_shard_0_mzml.mzml", "test_shard_1_mzml.mzml"],
+                         "test_merged_mzml.mzml")